@@ -3,30 +3,39 @@ from uuid import UUID
 
 from fastapi import (
     APIRouter,
-    BackgroundTasks,
     Depends,
     HTTPException,
 )
 from fastapi.params import Security
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from starlette.status import (
     HTTP_500_INTERNAL_SERVER_ERROR,
 )
 
+from app.core import config
 from app.core.dependencies import (
     RateLimiter,
     SessionDep,
     get_current_user,
 )
-from app.crud import download_batch
+from app.crud import download_batch, job
 from app.models.download_batch import (
+    ArchiveCompression,
     DownloadBatchCreate,
     DownloadBatchPublic,
+    DownloadShard,
     DownloadStatus,
 )
+from app.models.job import JobCreate, JobKind
 from app.models.user import User
-from app.services.buckets import get_download_batch
-from app.tasks.download_packaging import create_download_batch
+from app.services.buckets import get_download_batch_path
+from app.tasks.download_packaging import (
+    get_shard_extension,
+    release_download_batch,
+    sample_download_batch,
+    stream_download_batch,
+    use_cached_download_batch,
+)
 
 router = APIRouter()
 
@@ -56,12 +65,35 @@ def get_download_batch_status(
 )
 def request_download_batch(
     request: DownloadBatchCreate,
-    background_tasks: BackgroundTasks,
     user: Annotated[User, Depends(get_current_user)],
     session: SessionDep,
 ) -> DownloadBatchPublic:
+    if request.since_batch is not None:
+        previous = download_batch.get(session, request.since_batch)
+        if previous is None or previous.user_id != user.id:
+            raise HTTPException(status_code=404, detail="Previous batch not found")
+        request.since = previous.watermark or previous.start_time
+        request.since_id = previous.watermark_id
+
     try:
         batch = download_batch.create(session, request, user)
+        assert batch.id
+        if (
+            batch.image_count <= config.STREAMED_DOWNLOAD_MAX_COUNT
+            and not batch.sharded
+            and not batch.packed
+            and batch.since is None  # Its watermark has to be recorded
+        ):
+            # Small batches are quick enough to build while they download,
+            # from the images sampled now
+            sample_download_batch(session, batch)
+            download_batch.update(
+                session, batch.id, {"streamed": True, "status": DownloadStatus.READY}
+            )
+        elif not use_cached_download_batch(session, batch):
+            job.create(
+                session, JobCreate(kind=JobKind.CREATE_DOWNLOAD, target_id=batch.id)
+            )
 
     except Exception:
         raise HTTPException(
@@ -69,10 +101,14 @@ def request_download_batch(
             detail="Failed to add batch to database",
         ) from None
 
-    background_tasks.add_task(create_download_batch, batch_id=batch.id)
     return batch.get_public()
 
 
+@router.get(
+    "/get/{batch_id}",
+    tags=["Download"],
+    dependencies=[Depends(RateLimiter(requests_limit=2, time_window=60))],
+)
 @router.put(
     "/get/{batch_id}",
     tags=["Download"],
@@ -82,7 +118,7 @@ def download_download_batch(
     batch_id: UUID,
     user: Annotated[User, Depends(get_current_user)],
     session: SessionDep,
-) -> StreamingResponse:
+) -> Response:
     batch = download_batch.get(session, batch_id)
     if batch is None:
         raise HTTPException(status_code=404, detail="Batch not found")
@@ -90,13 +126,105 @@ def download_download_batch(
     if batch.status != DownloadStatus.READY:
         raise HTTPException(status_code=400, detail="Batch is not ready to download")
 
-    return StreamingResponse(
-        content=get_download_batch(batch_id),
-        media_type="application/gzip",
-        headers={"Content-Disposition": "attachment; filename=images.tar.gz"},
+    if batch.sharded:
+        raise HTTPException(
+            status_code=400, detail="Batch is sharded, download its shards instead"
+        )
+
+    extension = config.ARCHIVE_EXTENSIONS[batch.compression]
+    if batch.streamed:
+        # Built while it downloads, so the size isn't known and it can't resume
+        return StreamingResponse(
+            content=stream_download_batch(batch_id),
+            media_type=config.ARCHIVE_MEDIA_TYPES[batch.compression],
+            headers={"Content-Disposition": f"attachment; filename=images{extension}"},
+        )
+
+    return _archive_response(
+        get_download_batch_path(batch.archive_id or batch_id, extension),
+        "images" + extension,
+        batch.compression,
+        batch.hash,
     )
 
 
+@router.get(
+    "/get/{batch_id}/{shard}",
+    tags=["Download"],
+    dependencies=[Depends(RateLimiter(requests_limit=60, time_window=60))],
+)
+@router.put(
+    "/get/{batch_id}/{shard}",
+    tags=["Download"],
+    dependencies=[Depends(RateLimiter(requests_limit=60, time_window=60))],
+)
+def download_download_batch_shard(
+    batch_id: UUID,
+    shard: int,
+    user: Annotated[User, Depends(get_current_user)],
+    session: SessionDep,
+) -> Response:
+    batch = download_batch.get(session, batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    # Shards can be downloaded as soon as they are listed, before the batch is ready
+    shards = {i.index: i for i in map(DownloadShard.model_validate, batch.shards or [])}
+    if batch.status == DownloadStatus.FAILED or shard not in shards:
+        raise HTTPException(status_code=404, detail="Shard not found")
+
+    extension = config.ARCHIVE_EXTENSIONS[batch.compression]
+    return _archive_response(
+        get_download_batch_path(
+            batch.archive_id or batch_id, get_shard_extension(shard, extension)
+        ),
+        f"images-{shard:05d}{extension}",
+        batch.compression,
+        shards[shard].hash,
+    )
+
+
+def _archive_response(
+    path: str, filename: str, compression: ArchiveCompression, sha256: str | None
+) -> FileResponse:
+    """
+    Serve a stored archive with its size, and its sha256 as the ETag.
+    `FileResponse` honours `Range` and `If-Range` with 206 responses, so
+    dropped downloads can resume, and sends the file with `sendfile` when
+    the server supports it.
+    """
+    headers = {"ETag": f'"{sha256}"'} if sha256 else None
+    return FileResponse(
+        path,
+        media_type=config.ARCHIVE_MEDIA_TYPES[compression],
+        filename=filename,
+        headers=headers,
+    )
+
+
+@router.delete(
+    "/{batch_id}",
+    tags=["Download"],
+    dependencies=[Depends(RateLimiter(requests_limit=10, time_window=60))],
+)
+def delete_download_batch(
+    batch_id: UUID,
+    user: Annotated[User, Depends(get_current_user)],
+    session: SessionDep,
+) -> dict[str, str]:
+    batch = download_batch.get(session, batch_id)
+    if batch is None or batch.user_id != user.id:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    try:
+        release_download_batch(session, batch)
+    except Exception as e:
+        session.rollback()
+        raise HTTPException(status_code=500, detail=str(e)) from None
+
+    return {"detail": "Successfully deleted"}
+
+
 @router.get("/history")
 def get_download_batch_history(
     session: SessionDep,
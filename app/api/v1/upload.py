@@ -1,11 +1,11 @@
 import tarfile
+import zlib
 from datetime import datetime, timezone
-from typing import Annotated
+from typing import Annotated, BinaryIO
 from uuid import UUID
 
 from fastapi import (
     APIRouter,
-    BackgroundTasks,
     Depends,
     HTTPException,
     Security,
@@ -18,19 +18,17 @@ from app.core.dependencies import (
     SessionDep,
     get_current_user,
 )
-from app.core.helpers import (
-    get_hash_with_streaming,
-)
-from app.crud import upload_batch
+from app.core.helpers import HashingReader
+from app.crud import job, upload_batch
+from app.models.job import JobCreate, JobKind
 from app.models.upload_batch import (
     UploadBatchCreate,
     UploadBatchPublic,
 )
 from app.models.user import User
-from app.services.buckets import create_upload_batch
+from app.services.buckets import delete_upload_batch, open_upload_batch
 from app.tasks.image_processing import (
     estimate_upload_processing_time,
-    process_batch_async,
     validate_image_pre,
 )
 
@@ -61,36 +59,8 @@ def get_upload_batch_status(
 async def check_upload_archive(
     archive: UploadFile, hash: str, user: Annotated[User, Depends(get_current_user)]
 ) -> dict[str, str]:
-    if not tarfile.is_tarfile(archive.file):
-        raise HTTPException(status_code=415, detail="File must be of type .tar.gz")
-
-    if archive.size and (archive.size > config.MAX_FILE_SIZE):
-        raise HTTPException(
-            status_code=413,
-            detail=f"File is too large. Max size: {config.MAX_FILE_SIZE / (1024**3):.1f}GB",
-        )
-
-    if get_hash_with_streaming(archive.file, config.BUCKET_NAME_HASH_ALGORITHM) != hash:
-        raise HTTPException(
-            status_code=400,
-            detail="Uploaded file is corrupted (hash mismatch) (Are you using sha256?)",
-        )
-
-    archive.file.seek(0)
-    with tarfile.open(fileobj=archive.file, mode="r:gz") as tar:
-        image_files = [m for m in tar.getmembers() if m.isfile()]
-
-        if len(image_files) == 0:
-            raise HTTPException(
-                status_code=400, detail="Archive is empty. Are the images in root?"
-            )
-
-        for i in image_files:
-            if not validate_image_pre(i):
-                raise HTTPException(
-                    status_code=400,
-                    detail=f'Image "{i.name}" is not a supported file type. See `PIL.Image.registered_extensions().items()`',
-                )
+    _check_upload_size(archive)
+    _verify_upload_archive(archive.file, hash)
 
     return {"status": "success"}
 
@@ -103,7 +73,6 @@ async def check_upload_archive(
 async def upload(
     archive: UploadFile,
     hash: str,
-    background_tasks: BackgroundTasks,
     user: Annotated[User, Depends(get_current_user)],
     session: SessionDep,
     capture_time: datetime = datetime.now(timezone.utc),
@@ -118,7 +87,7 @@ async def upload(
     `capture_time`: The rough time that the data was gathered
     """
 
-    await check_upload_archive(archive, hash, user)
+    _check_upload_size(archive)
 
     try:
         assert user.id
@@ -140,15 +109,83 @@ async def upload(
         ) from None
 
     assert batch.id
-    create_upload_batch(archive.file, batch.id)
+    try:
+        # Check the archive while it is copied into storage
+        with open_upload_batch(batch.id) as stored:
+            images_total = _verify_upload_archive(archive.file, hash, stored)
+    except Exception:
+        delete_upload_batch(batch.id)
+        upload_batch.delete(session, batch.id)
+        raise
 
-    background_tasks.add_task(process_batch_async, batch_id=batch.id)
+    updated_batch = upload_batch.update(
+        session, batch.id, {"images_total": images_total}
+    )
+    assert updated_batch
 
-    out = batch.get_public()
+    job.create(session, JobCreate(kind=JobKind.PROCESS_UPLOAD, target_id=batch.id))
+
+    out = updated_batch.get_public()
     out.estimated_time_left = config.DEFAULT_PROCESSING_TIME
     return out
 
 
+def _check_upload_size(archive: UploadFile) -> None:
+    if archive.size and (archive.size > config.MAX_FILE_SIZE):
+        raise HTTPException(
+            status_code=413,
+            detail=f"File is too large. Max size: {config.MAX_FILE_SIZE / (1024**3):.1f}GB",
+        )
+
+
+def _verify_upload_archive(
+    file: BinaryIO, hash: str, sink: BinaryIO | None = None
+) -> int:
+    """
+    Check an uploaded archive in a single streaming pass. The body is
+    hashed, its tar headers are checked, and it is copied to `sink` (if
+    given) all while it is read, so memory use stays flat no matter how
+    big it is. Returns the # of files in the archive.
+    """
+    file.seek(0)
+    reader = HashingReader(file, config.BUCKET_NAME_HASH_ALGORITHM, sink)
+    file_count = 0
+
+    try:
+        with tarfile.open(fileobj=reader, mode="r|gz") as tar:  # type: ignore[call-overload]
+            for member in tar:
+                # Only the headers are needed, one at a time
+                tar.members = []
+                if not member.isfile():
+                    continue
+
+                if not validate_image_pre(member):
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f'Image "{member.name}" is not a supported file type. See `PIL.Image.registered_extensions().items()`',
+                    )
+                file_count += 1
+    except (tarfile.TarError, zlib.error, EOFError):
+        raise HTTPException(
+            status_code=415, detail="File must be of type .tar.gz"
+        ) from None
+
+    reader.drain()  # Hash (and store) anything after the last header
+
+    if reader.hexdigest() != hash:
+        raise HTTPException(
+            status_code=400,
+            detail="Uploaded file is corrupted (hash mismatch) (Are you using sha256?)",
+        )
+
+    if file_count == 0:
+        raise HTTPException(
+            status_code=400, detail="Archive is empty. Are the images in root?"
+        )
+
+    return file_count
+
+
 @router.get("/history")
 def get_upload_batch_history(
     session: SessionDep,
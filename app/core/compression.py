@@ -0,0 +1,110 @@
+"""
+Writers that compress whatever is written to them on the way to another
+file. They leave that file open when closed, so they can be stacked.
+"""
+
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Protocol
+
+import zstandard
+
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+_DEFLATE_WINDOW = 32 * 1024
+
+
+class Writable(Protocol):
+    def write(self, data: bytes, /) -> int: ...
+
+
+class CompressingWriter(Writable, Protocol):
+    def close(self) -> None: ...
+
+
+class ParallelGzipWriter:
+    """
+    Gzip compresses in fixed size blocks spread over a thread pool, the way
+    pigz does. Each block is primed with the last 32KB before it and ends on
+    a byte boundary, so the blocks join into one ordinary gzip stream.
+    """
+
+    def __init__(
+        self, file: Writable, level: int, threads: int, block_size: int
+    ) -> None:
+        self.file = file
+        self.level = level
+        self.block_size = block_size
+        self._pool = ThreadPoolExecutor(threads)
+        self._max_pending = threads * 2
+        self._pending: deque[Future[bytes]] = deque()
+        self._buffer = bytearray()
+        self._window = b""
+        self._crc = 0
+        self._size = 0
+        self._closed = False
+        self.file.write(_GZIP_HEADER)
+
+    def write(self, data: bytes) -> int:
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]), last=False)
+            del self._buffer[: self.block_size]
+
+        return len(data)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+
+        self._submit(bytes(self._buffer), last=True)
+        self._buffer.clear()
+        while self._pending:
+            self.file.write(self._pending.popleft().result())
+
+        self._pool.shutdown()
+        self.file.write(struct.pack("<II", self._crc, self._size & 0xFFFFFFFF))
+
+    def _submit(self, block: bytes, last: bool) -> None:
+        self._pending.append(
+            self._pool.submit(self._compress, block, self._window, last)
+        )
+        self._window = (self._window + block)[-_DEFLATE_WINDOW:]
+
+        while len(self._pending) > self._max_pending:
+            self.file.write(self._pending.popleft().result())
+
+    def _compress(self, block: bytes, window: bytes, last: bool) -> bytes:
+        if window:
+            compressor = zlib.compressobj(
+                self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=window
+            )
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        data = compressor.compress(block)
+        return data + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class PlainWriter:
+    """Passes writes straight through, for archives that aren't compressed"""
+
+    def __init__(self, file: Writable) -> None:
+        self.file = file
+
+    def write(self, data: bytes) -> int:
+        return self.file.write(data)
+
+    def close(self) -> None:
+        pass
+
+
+def zstd_writer(file: Writable, level: int, threads: int) -> CompressingWriter:
+    compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+    writer: CompressingWriter = compressor.stream_writer(file, closefd=False)  # type: ignore[arg-type]
+    return writer
@@ -1,5 +1,6 @@
 # TODO: Sort this file
 import os
+from typing import Any
 
 from dotenv import load_dotenv
 from PIL import Image
@@ -18,6 +19,14 @@ ALLOWED_IMAGE_EXTENSIONS = {
     ex for ex, f in Image.registered_extensions().items() if f in Image.OPEN
 }
 IMAGE_STORAGE_FORMAT = "png"
+IMAGE_PASSTHROUGH = True  # Store uploads already in IMAGE_STORAGE_FORMAT as-is
+IMAGE_ENCODER_OPTIONS: dict[str, dict[str, Any]] = {  # Passed to `Image.save`
+    "png": {"compress_level": 1},  # Pillow defaults to 6, which is far slower
+    "webp": {"lossless": True, "method": 4},
+}
+IMAGE_INSERT_CHUNK_SIZE = 100
+UPLOAD_PROGRESS_FLUSH_COUNT = 100
+UPLOAD_PROGRESS_FLUSH_SECONDS = 2
 DEFAULT_PROCESSING_TIME = 100
 TEMPLATES_PATH = "web/templates"
 SECURE_ALGORITHM = "HS256"
@@ -36,12 +45,36 @@ VERIFICATION_CODE_BYTES_LEN = 16
 API_KEY_LEN = 16
 MAX_DOWNLOAD_COUNT = 10000
 DOWNLOAD_BATCH_SAVE_DISTANCE = 5
+STREAMED_DOWNLOAD_MAX_COUNT = 500  # Smaller batches are built while downloading
+DOWNLOAD_PREFETCH_WORKERS = 8  # Threads fetching images from storage
+DOWNLOAD_PREFETCH_COUNT = 32  # Images fetched ahead of the one being written
+DOWNLOAD_SHARD_SIZE = 1000  # Images per shard of a sharded download
+DOWNLOAD_SHARD_WORKERS = 4  # Shards written at once
+DOWNLOAD_SAMPLE_RUNS = 16  # Random points a download's sample is drawn from
+MANIFEST_SPOOL_SIZE = 8 * 1024 * 1024  # Manifest bytes kept in memory before disk
+COLUMNAR_BATCH_SIZE = 10000  # Annotation rows per Parquet/Arrow record batch
+PACKED_IMAGE_SIZE = 640  # Width and height of images in packed downloads
+ARCHIVE_BLOCK_SIZE = 128 * 1024  # Bytes per block when gzipping in parallel
+ARCHIVE_GZIP_LEVEL = 6  # Images are already compressed, so 9 gains ~nothing
+ARCHIVE_ZSTD_LEVEL = 3
+ARCHIVE_EXTENSIONS = {"none": ".tar", "gzip": ".tar.gz", "zstd": ".tar.zst"}
+ARCHIVE_MEDIA_TYPES = {
+    "none": "application/x-tar",
+    "gzip": "application/gzip",
+    "zstd": "application/zstd",
+}
+JOB_LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 3
+WORKER_POLL_SECONDS = 2
 IS_PRODUCTION = False
 
 load_dotenv()
 JWT_SECRET_TOKEN = os.getenv("JWT_SECRET_KEY")
 DATABASE_URL = os.getenv("DATABASE_URL")
 DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 2))
+COMPRESSION_THREADS = int(os.getenv("COMPRESSION_THREADS", os.cpu_count() or 1))
 
 if DEBUG:
     PROJECT_URL = "127.0.0.1:8000"
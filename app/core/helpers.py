@@ -1,31 +1,61 @@
 import hashlib
-import json
-from typing import Any, BinaryIO, TypeVar
-from uuid import UUID
+from typing import BinaryIO, TypeVar
 
 from sqlmodel import SQLModel
 
 from app.core import config
 
 
-def get_hash_with_streaming(file: BinaryIO, algorithm: str) -> str:
-    h = hashlib.new(algorithm)
-    file.seek(0)
-    while True:
-        data = file.read(config.HASHING_BUF_SIZE)
-        if not data:
-            break
-        h.update(data)
+class HashingReader:
+    """
+    Wraps a binary file so that everything read from it is also hashed and,
+    if a `sink` is given, copied to it. This lets one pass over a stream do
+    the work of several.
+    """
 
-    return h.hexdigest()
+    def __init__(
+        self, file: BinaryIO, algorithm: str, sink: BinaryIO | None = None
+    ) -> None:
+        self.file = file
+        self.sink = sink
+        self.size = 0
+        self._hash = hashlib.new(algorithm)
 
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self._hash.update(data)
+        if self.sink is not None:
+            self.sink.write(data)
+        self.size += len(data)
+        return data
 
-class UUIDEncoder(json.JSONEncoder):
-    def default(self, o: Any) -> Any:
-        if isinstance(o, UUID):
-            # if the o is uuid, we return the value of uuid
-            return o.hex
-        return json.JSONEncoder.default(self, o)
+    def drain(self) -> None:
+        """Read whatever is left of the file"""
+        while self.read(config.HASHING_BUF_SIZE):
+            pass
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+class HashingWriter:
+    """
+    Wraps a binary file so that everything written to it is also hashed
+    and counted, saving a second read of whatever was written.
+    """
+
+    def __init__(self, file: BinaryIO, algorithm: str) -> None:
+        self.file = file
+        self.size = 0
+        self._hash = hashlib.new(algorithm)
+
+    def write(self, data: bytes) -> int:
+        self._hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
 
 
 T = TypeVar("T", bound=SQLModel)
@@ -1,11 +1,25 @@
-from sqlmodel import Session
+from datetime import datetime, timezone
+from uuid import UUID
 
-from app.models.annotation import Annotation, AnnotationCreate, AnnotationUpdate
+from sqlalchemy import delete as sql_delete
+from sqlalchemy import update as sql_update
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import Session, col, select
+
+from app.models.annotation import (
+    Annotation,
+    AnnotationCreate,
+    AnnotationUpdate,
+    ImageCategory,
+)
+from app.models.image import Image
 
 
 def create(session: Session, annotation_create: AnnotationCreate) -> Annotation:
     annotation: Annotation = Annotation.model_validate(annotation_create)
     session.add(annotation)
+    _touch_image(session, annotation.image_id)
+    _sync_image_category(session, annotation.image_id, annotation.category_id)
     session.commit()
     session.refresh(annotation)
     return annotation
@@ -27,9 +41,15 @@ def update(
     if isinstance(annotation_update, dict):
         annotation_update = AnnotationUpdate(**annotation_update)
 
+    old_image_id, old_category_id = annotation.image_id, annotation.category_id
     new_annotation_data = annotation_update.model_dump(exclude_unset=True)
     annotation.sqlmodel_update(new_annotation_data)
     session.add(annotation)
+    _touch_image(session, old_image_id)
+    if annotation.image_id != old_image_id:
+        _touch_image(session, annotation.image_id)
+    _sync_image_category(session, old_image_id, old_category_id)
+    _sync_image_category(session, annotation.image_id, annotation.category_id)
     session.commit()
     session.refresh(annotation)
     return annotation
@@ -41,5 +61,60 @@ def delete(session: Session, id: int) -> bool:
         return False
 
     session.delete(annotation)
+    _touch_image(session, annotation.image_id)
+    _sync_image_category(session, annotation.image_id, annotation.category_id)
     session.commit()
     return True
+
+
+def backfill_image_categories(session: Session) -> None:
+    """
+    Add the category memberships of annotations written before
+    `image_categories` was kept in step with them. A full scan of the
+    annotations, so it is run once by `scripts/backfill_image_categories.py`
+    """
+    session.execute(
+        insert(ImageCategory)
+        .from_select(
+            ["image_id", "category_id"],
+            select(col(Annotation.image_id), col(Annotation.category_id)).distinct(),
+        )
+        .on_conflict_do_nothing()
+    )
+    session.commit()
+
+
+def _touch_image(session: Session, image_id: UUID) -> None:
+    """Mark an image as changed, so delta downloads pick up its annotations"""
+    session.execute(
+        sql_update(Image)
+        .where(col(Image.id) == image_id)
+        .values(updated_at=datetime.now(timezone.utc))
+    )
+
+
+def _sync_image_category(session: Session, image_id: UUID, category_id: int) -> None:
+    """
+    Add or remove the image's membership of the category, depending on
+    whether it still has an annotation in it
+    """
+    session.flush()
+    annotated = session.exec(
+        select(Annotation.id)
+        .where(col(Annotation.image_id) == image_id)
+        .where(col(Annotation.category_id) == category_id)
+        .limit(1)
+    ).first()
+
+    if annotated is None:
+        session.execute(
+            sql_delete(ImageCategory)
+            .where(col(ImageCategory.image_id) == image_id)
+            .where(col(ImageCategory.category_id) == category_id)
+        )
+    else:
+        session.execute(
+            insert(ImageCategory)
+            .values(image_id=image_id, category_id=category_id)
+            .on_conflict_do_nothing()
+        )
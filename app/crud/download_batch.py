@@ -1,11 +1,12 @@
 from uuid import UUID
 
-from sqlmodel import Session
+from sqlmodel import Session, col, func, select
 
 from app.models.download_batch import (
     DownloadBatch,
     DownloadBatchCreate,
     DownloadBatchUpdate,
+    DownloadStatus,
 )
 from app.models.user import User
 
@@ -13,9 +14,12 @@ from app.models.user import User
 def create(
     session: Session, download_batch_create: DownloadBatchCreate, user: User
 ) -> DownloadBatch:
-    download_batch: DownloadBatch = DownloadBatch.model_validate(download_batch_create)
-    assert user.id
-    download_batch.user_id = user.id
+    data = download_batch_create.model_dump()
+    data["image_count"] = data.pop("count")
+    data.pop("since_batch")  # Resolved to `since` and `since_id` by the caller
+    data["user_id"] = user.id
+    download_batch: DownloadBatch = DownloadBatch.model_validate(data)
+    download_batch.annotations = data["annotations"]  # The JSON column needs dicts
     session.add(download_batch)
     session.commit()
     session.refresh(download_batch)
@@ -27,6 +31,28 @@ def get(session: Session, id: UUID) -> DownloadBatch | None:
     return download_batch
 
 
+def get_cached(session: Session, fingerprint: str) -> DownloadBatch | None:
+    """Find a finished, stored batch built from an identical request"""
+    download_batch: DownloadBatch | None = session.exec(
+        select(DownloadBatch)
+        .where(col(DownloadBatch.fingerprint) == fingerprint)
+        .where(col(DownloadBatch.status) == DownloadStatus.READY)
+        .where(col(DownloadBatch.archive_id).is_not(None))
+        .limit(1)
+    ).first()
+    return download_batch
+
+
+def count_archive_references(session: Session, archive_id: UUID) -> int:
+    """Count the batches that are served from the stored archive `archive_id`"""
+    count: int = session.exec(
+        select(func.count())
+        .select_from(DownloadBatch)
+        .where(col(DownloadBatch.archive_id) == archive_id)
+    ).one()
+    return count
+
+
 def update(
     session: Session, id: UUID, download_batch_update: DownloadBatchUpdate | dict
 ) -> DownloadBatch | None:
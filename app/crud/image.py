@@ -1,8 +1,10 @@
+from datetime import datetime, timezone
 from uuid import UUID
 
-from sqlmodel import Session
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import Session, col
 
-from app.models.image import Image, ImageCreate, ImageUpdate
+from app.models.image import Image, ImageCreate, ImageTombstone, ImageUpdate
 from app.models.user import User
 
 
@@ -16,6 +18,35 @@ def create(session: Session, image_create: ImageCreate, user: User) -> Image:
     return image
 
 
+def create_many(
+    session: Session, image_creates: list[ImageCreate], user: User
+) -> list[UUID | None]:
+    """
+    Insert many images with a single `INSERT ... RETURNING`. Images whose
+    hash is already stored are skipped. Nothing is committed, so the rows
+    can be committed together with other work. Returns the new ids in the
+    same order as `image_creates`, with `None` for skipped images.
+    """
+    if not image_creates:
+        return []
+
+    rows = []
+    for image_create in image_creates:
+        data = image_create.model_dump()
+        data["created_by"] = user.id
+        rows.append(Image.model_validate(data).model_dump())
+
+    inserted = set(
+        session.scalars(
+            insert(Image)
+            .on_conflict_do_nothing(index_elements=[col(Image.hash)])
+            .returning(col(Image.id)),
+            rows,
+        ).all()
+    )
+    return [row["id"] if row["id"] in inserted else None for row in rows]
+
+
 def get(session: Session, id: UUID) -> Image | None:
     image: Image | None = session.get(Image, id)
     return image
@@ -33,6 +64,7 @@ def update(
 
     new_image_data = image_update.model_dump(exclude_unset=True)
     image.sqlmodel_update(new_image_data)
+    image.updated_at = datetime.now(timezone.utc)
     session.add(image)
     session.commit()
     session.refresh(image)
@@ -47,5 +79,6 @@ def delete(session: Session, id: UUID) -> bool:
         return False
 
     session.delete(image)
+    session.merge(ImageTombstone(image_id=id))
     session.commit()
     return True
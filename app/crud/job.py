@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlmodel import Session, and_, col, or_, select
+
+from app.core import config
+from app.models.job import Job, JobCreate, JobStatus, JobUpdate
+
+
+def create(session: Session, job_create: JobCreate) -> Job:
+    job: Job = Job.model_validate(job_create)
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+def get(session: Session, id: int) -> Job | None:
+    job: Job | None = session.get(Job, id)
+    return job
+
+
+def update(session: Session, id: int, job_update: JobUpdate | dict) -> Job | None:
+    job: Job | None = session.get(Job, id)
+    if job is None:
+        return None
+
+    if isinstance(job_update, dict):
+        job_update = JobUpdate(**job_update)
+
+    new_job_data = job_update.model_dump(exclude_unset=True)
+    job.sqlmodel_update(new_job_data)
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+def delete(session: Session, id: int) -> bool:
+    job = session.get(Job, id)
+    if job is None:
+        return False
+
+    session.delete(job)
+    session.commit()
+    return True
+
+
+def lease(session: Session, worker: str) -> Job | None:
+    """
+    Claim the oldest queued job, or a running job whose lease has run out.
+    Uses `FOR UPDATE SKIP LOCKED` so many workers can poll at once without
+    blocking each other or taking the same job.
+    """
+    now = datetime.now(timezone.utc)
+    job = session.exec(
+        select(Job)
+        .where(
+            or_(
+                col(Job.status) == JobStatus.QUEUED,
+                and_(
+                    col(Job.status) == JobStatus.RUNNING,
+                    col(Job.leased_until) < now,
+                ),
+            )
+        )
+        .order_by(col(Job.id))
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    ).first()
+
+    if job is None:
+        session.commit()
+        return None
+
+    job.status = JobStatus.RUNNING
+    job.attempts += 1
+    job.leased_by = worker
+    job.leased_until = now + timedelta(seconds=config.JOB_LEASE_SECONDS)
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+def renew_lease(session: Session, id: int, worker: str) -> bool:
+    """
+    Push back the lease on a job this worker holds. Returns `False` if the
+    lease has been lost, e.g. to a worker that took the job over after it ran
+    out.
+    """
+    job = _get_leased(session, id, worker)
+    if job is None:
+        session.commit()
+        return False
+
+    job.leased_until = datetime.now(timezone.utc) + timedelta(
+        seconds=config.JOB_LEASE_SECONDS
+    )
+    session.add(job)
+    session.commit()
+    return True
+
+
+def finish(
+    session: Session, id: int, worker: str, error: str | None = None
+) -> Job | None:
+    """
+    Mark a job as done, or record its error. Failed jobs are queued again
+    until they have used up `JOB_MAX_ATTEMPTS`. Nothing changes unless
+    `worker` still holds the lease, so a worker that lost the job can't undo
+    the work of the one that took it over. Returns `None` in that case.
+    """
+    job = _get_leased(session, id, worker)
+    if job is None:
+        session.commit()
+        return None
+
+    if error is None:
+        job.status = JobStatus.DONE
+    elif job.attempts < config.JOB_MAX_ATTEMPTS:
+        job.status = JobStatus.QUEUED
+    else:
+        job.status = JobStatus.FAILED
+
+    job.error_message = error[:500] if error else None
+    job.leased_by = None
+    job.leased_until = None
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+def _get_leased(session: Session, id: int, worker: str) -> Job | None:
+    """The job, locked until the next commit, if `worker` holds its lease"""
+    return session.exec(
+        select(Job)
+        .where(col(Job.id) == id)
+        .where(col(Job.status) == JobStatus.RUNNING)
+        .where(col(Job.leased_by) == worker)
+        .with_for_update()
+    ).first()
@@ -1,6 +1,8 @@
+from typing import Any
 from uuid import UUID
 
-from sqlmodel import Session
+from sqlalchemy import update as sql_update
+from sqlmodel import Session, col
 
 from app.core.helpers import validated
 from app.models.upload_batch import UploadBatch, UploadBatchCreate, UploadBatchUpdate
@@ -37,6 +39,27 @@ def update(
     return upload_batch
 
 
+def increment(
+    session: Session, id: UUID, counts: dict[str, int], checkpoint: int | None = None
+) -> None:
+    """
+    Atomically add `counts` to the batch's counter columns, e.g.
+    `{"images_valid": 3}` runs `SET images_valid = images_valid + 3`.
+    The checkpoint is saved in the same statement if one is given.
+    """
+    values: dict[str, Any] = {
+        k: getattr(UploadBatch, k) + v for k, v in counts.items() if v
+    }
+    if checkpoint is not None:
+        values["checkpoint"] = checkpoint
+
+    if values:
+        session.execute(
+            sql_update(UploadBatch).where(col(UploadBatch.id) == id).values(values)
+        )
+    session.commit()
+
+
 def delete(session: Session, id: UUID) -> bool:
     upload_batch = session.get(UploadBatch, id)
     if upload_batch is None:
@@ -17,9 +17,10 @@ def get_session() -> Generator[Session, Any, None]:
 
 def init_db() -> None:
     from app.models import configure_relationships
-    from app.models.annotation import Annotation  # noqa: F401
-    from app.models.download_batch import DownloadBatch  # noqa: F401
-    from app.models.image import Image  # noqa: F401
+    from app.models.annotation import Annotation, ImageCategory  # noqa: F401
+    from app.models.download_batch import DownloadBatch, DownloadBatchUpdate
+    from app.models.image import Image, ImageTombstone  # noqa: F401
+    from app.models.job import Job  # noqa: F401
     from app.models.team import Team  # noqa: F401
     from app.models.upload_batch import UploadBatch  # noqa: F401
     from app.models.user import User  # noqa: F401
@@ -28,7 +29,9 @@ def init_db() -> None:
 
     Annotation.model_rebuild()
     DownloadBatch.model_rebuild()
+    DownloadBatchUpdate.model_rebuild()
     Image.model_rebuild()
+    Job.model_rebuild()
     Team.model_rebuild()
     UploadBatch.model_rebuild()
     User.model_rebuild()
@@ -37,8 +37,25 @@ class Annotation(AnnotationBase, table=True):
         return validated(AnnotationPublic, self)
 
 
+class ImageCategory(SQLModel, table=True):
+    """
+    Each category an image has at least one annotation in. It is kept in
+    step with `annotations`, so downloads can sample by category with an
+    index instead of loading annotations.
+    """
+
+    __tablename__ = "image_categories"  # type: ignore
+
+    image_id: UUID = Field(
+        foreign_key="images.id", primary_key=True, ondelete="CASCADE"
+    )
+    category_id: int = Field(
+        foreign_key="label_categories.id", primary_key=True, index=True
+    )
+
+
 class AnnotationCreate(AnnotationBase):
-    pass
+    image_id: UUID
 
 
 class AnnotationUpdate(SQLModel):
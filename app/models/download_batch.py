@@ -3,11 +3,10 @@ from enum import Enum
 from typing import TYPE_CHECKING
 from uuid import UUID, uuid4
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationInfo, field_validator
 from sqlmodel import JSON, Column, Field, Relationship, SQLModel
 
 from app.core import config
-from app.core.helpers import validated
 
 if TYPE_CHECKING:
     from app.models.user import User
@@ -22,18 +21,53 @@ class DownloadStatus(str, Enum):
     FAILED = "failed"
 
 
+class ArchiveCompression(str, Enum):
+    NONE = "none"
+    GZIP = "gzip"
+    ZSTD = "zstd"
+
+
+class AnnotationFormat(str, Enum):
+    COCO = "coco"
+    PARQUET = "parquet"
+    ARROW = "arrow"
+
+
 class AnnotationSelection(BaseModel):
     id: int
     super: bool
 
 
+class DownloadShard(BaseModel):
+    index: int
+    image_count: int
+    hash: str
+    file_size: int
+
+
 class BaseDownloadBatch(SQLModel):
     status: "DownloadStatus" = Field(default=DownloadStatus.STARTING)
     non_match_images: bool = Field(default=True)
     image_count: int = Field(ge=1, le=config.MAX_DOWNLOAD_COUNT)
     annotations: list["AnnotationSelection"] = Field(sa_column=Column(JSON))
+    compression: ArchiveCompression = Field(default=ArchiveCompression.GZIP)
+    annotation_format: AnnotationFormat = Field(default=AnnotationFormat.COCO)
+    seed: int | None = Field(default=None)  # Makes the sample reproducible
+    splits: dict[str, float] | None = Field(default=None, sa_column=Column(JSON))
+    sharded: bool = Field(default=False)
+    packed: bool = Field(default=False)  # Images as one NumPy array
+    # Only images changed after `since` are included, up to `watermark`. Ties
+    # on the time are broken by image id, so a delta can resume part way
+    # through images changed at the same moment
+    since: datetime | None = Field(default=None)
+    since_id: UUID | None = Field(default=None)
+    watermark: datetime | None = Field(default=None)
+    watermark_id: UUID | None = Field(default=None)
+    shards: list["DownloadShard"] | None = Field(default=None, sa_column=Column(JSON))
     start_time: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     hash: str | None = Field(default=None)
+    file_size: int | None = Field(default=None, ge=0)
+    streamed: bool = Field(default=False)  # Built on the fly when downloaded
     error_message: str | None = Field(default=None, max_length=500)
 
 
@@ -42,12 +76,21 @@ class DownloadBatch(BaseDownloadBatch, table=True):
 
     id: UUID | None = Field(default_factory=uuid4, primary_key=True)
     user_id: int = Field(foreign_key="users.id", index=True)
+    # Requests with the same fingerprint share one stored archive, kept under
+    # the id of the batch that built it
+    fingerprint: str | None = Field(default=None, index=True)
+    archive_id: UUID | None = Field(default=None, index=True)
+    # Streamed batches are built again on every download, always from the
+    # images sampled when they were requested (as hex ids, in sample order)
+    image_ids: list[str] | None = Field(default=None, sa_column=Column(JSON))
 
     user: "User" = Relationship(back_populates="download_batches")
 
     def get_public(self) -> "DownloadBatchPublic":
-        public = validated(DownloadBatchPublic, self)
-        public.username = self.user.username
+        data = self.model_dump(warnings=False)  # `annotations` is stored as dicts
+        data["username"] = self.user.username
+        data["estimated_time_left"] = None
+        public: DownloadBatchPublic = DownloadBatchPublic.model_validate(data)
         return public
 
 
@@ -55,6 +98,37 @@ class DownloadBatchCreate(SQLModel):
     annotations: list["AnnotationSelection"]
     count: int
     non_match_images: bool = True
+    compression: ArchiveCompression = ArchiveCompression.GZIP
+    annotation_format: AnnotationFormat = AnnotationFormat.COCO
+    seed: int | None = None
+    splits: dict[str, float] | None = None  # Split names to ratios, e.g. train: 0.8
+    sharded: bool = False
+    packed: bool = False
+    since: datetime | None = None  # Only include images changed after this
+    since_id: UUID | None = None  # And after this image, if changed at `since`
+    since_batch: UUID | None = None  # Or since this earlier batch
+
+    @field_validator("packed")
+    @classmethod
+    def check_packed(cls, value: bool, info: ValidationInfo) -> bool:
+        if value and info.data.get("sharded"):
+            raise ValueError("A batch can't be both sharded and packed")
+        if value and info.data.get("annotation_format") != AnnotationFormat.COCO:
+            raise ValueError("Packed batches always store their labels as arrays")
+        return value
+
+    @field_validator("splits")
+    @classmethod
+    def check_splits(cls, value: dict[str, float] | None) -> dict[str, float] | None:
+        if value is None:
+            return None
+        if not all(name.isidentifier() for name in value):
+            raise ValueError("Split names must be plain words, like `train`")
+        if not value or any(ratio <= 0 for ratio in value.values()):
+            raise ValueError("Splits must have positive ratios")
+        if abs(sum(value.values()) - 1) > 1e-6:
+            raise ValueError("Split ratios must add up to 1")
+        return value
 
 
 class DownloadBatchUpdate(SQLModel):
@@ -62,12 +136,28 @@ class DownloadBatchUpdate(SQLModel):
     non_match_images: bool | None = None
     image_count: int | None = None
     annotations: list["AnnotationSelection"] | None = None
+    compression: ArchiveCompression | None = None
+    annotation_format: AnnotationFormat | None = None
+    seed: int | None = None
+    splits: dict[str, float] | None = None
+    sharded: bool | None = None
+    packed: bool | None = None
+    since: datetime | None = None
+    since_id: UUID | None = None
+    watermark: datetime | None = None
+    watermark_id: UUID | None = None
     start_time: datetime | None = None
     hash: str | None = None
+    file_size: int | None = None
+    streamed: bool | None = None
     error_message: str | None = None
+    fingerprint: str | None = None
+    archive_id: UUID | None = None
+    image_ids: list[str] | None = None
     user: "User | None" = None
 
 
 class DownloadBatchPublic(BaseDownloadBatch):
     id: UUID
-    estimated_time_left: float
+    username: str
+    estimated_time_left: float | None
@@ -1,3 +1,4 @@
+import random
 from datetime import datetime, timezone
 from enum import Enum
 from typing import TYPE_CHECKING
@@ -23,6 +24,10 @@ class ImageBase(SQLModel):
     review_status: ImageReviewStatus = Field(
         default=ImageReviewStatus.NOT_REVIEWED, index=True
     )
+    width: int | None = Field(default=None, ge=0)
+    height: int | None = Field(default=None, ge=0)
+    file_size: int | None = Field(default=None, ge=0)
+    hash: str | None = Field(default=None, unique=True, index=True)
 
 
 class Image(ImageBase, table=True):
@@ -32,6 +37,13 @@ class Image(ImageBase, table=True):
     created_at: datetime | None = Field(
         index=True, default_factory=lambda: datetime.now(timezone.utc)
     )
+    # A random position in [0, 1), indexed so download batches can be sampled
+    # by walking the index from a random point instead of scanning the table
+    sample_key: float = Field(default_factory=random.random, index=True)
+    # Bumped when the image or its annotations change, for delta downloads
+    updated_at: datetime | None = Field(
+        index=True, default_factory=lambda: datetime.now(timezone.utc)
+    )
 
     annotations: list["Annotation"] = Relationship(
         back_populates="image", sa_relationship_kwargs={"cascade": "all, delete-orphan"}
@@ -43,8 +55,23 @@ class Image(ImageBase, table=True):
         return public
 
 
+class ImageTombstone(SQLModel, table=True):
+    """Left behind by a deleted image, so delta downloads can report it"""
+
+    __tablename__ = "image_tombstones"  # type: ignore
+
+    image_id: UUID = Field(primary_key=True)
+    deleted_at: datetime = Field(
+        index=True, default_factory=lambda: datetime.now(timezone.utc)
+    )
+
+
 class ImageCreate(SQLModel):
     batch: UUID
+    width: int | None = None
+    height: int | None = None
+    file_size: int | None = None
+    hash: str | None = None
 
 
 class ImageUpdate(SQLModel):
@@ -0,0 +1,46 @@
+from datetime import datetime, timezone
+from enum import Enum
+from uuid import UUID
+
+from sqlmodel import Field, SQLModel
+
+
+class JobKind(str, Enum):
+    PROCESS_UPLOAD = "process_upload"
+    CREATE_DOWNLOAD = "create_download"
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class JobBase(SQLModel):
+    kind: JobKind = Field()
+    target_id: UUID = Field(index=True)  # The upload or download batch
+
+
+class Job(JobBase, table=True):
+    __tablename__ = "jobs"  # type: ignore
+
+    id: int | None = Field(default=None, primary_key=True)
+    status: JobStatus = Field(default=JobStatus.QUEUED, index=True)
+    attempts: int = Field(default=0, ge=0)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    leased_by: str | None = Field(default=None)
+    leased_until: datetime | None = Field(default=None, index=True)
+    error_message: str | None = Field(default=None, max_length=500)
+
+
+class JobCreate(JobBase):
+    pass
+
+
+class JobUpdate(SQLModel):
+    status: JobStatus | None = None
+    attempts: int | None = None
+    leased_by: str | None = None
+    leased_until: datetime | None = None
+    error_message: str | None = None
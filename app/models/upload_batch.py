@@ -23,6 +23,7 @@ class BaseUploadBatch(SQLModel):
     file_size: int | None = Field(default=None, ge=0, le=config.MAX_FILE_SIZE)
     images_valid: int = Field(default=0, ge=0)
     images_rejected: int = Field(default=0, ge=0)
+    images_deduplicated: int = Field(default=0, ge=0)
     images_total: int = Field(default=0, ge=0)
     capture_time: datetime = Field()
     start_time: datetime | None = Field(default=None)
@@ -34,6 +35,7 @@ class UploadBatch(BaseUploadBatch, table=True):
 
     id: UUID | None = Field(default_factory=uuid4, primary_key=True)
     user_id: int = Field(foreign_key="users.id", index=True)
+    checkpoint: int = Field(default=0, ge=0)  # File members already processed
 
     user: "User" = Relationship(back_populates="upload_batches")
 
@@ -56,6 +58,7 @@ class UploadBatchUpdate(SQLModel):
     file_size: int | None = None
     images_valid: int | None = None
     images_rejected: int | None = None
+    images_deduplicated: int | None = None
     images_total: int | None = None
     capture_time: datetime | None = None
     start_time: datetime | None = None
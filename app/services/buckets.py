@@ -5,6 +5,7 @@ a filesystem instead!
 """
 
 import os
+import shutil
 from typing import BinaryIO
 from uuid import UUID
 
@@ -30,36 +31,40 @@ def init() -> None:
         raise
 
 
-def create_upload_batch(archive: BinaryIO, uuid: UUID) -> None:
+def open_upload_batch(uuid: UUID) -> BinaryIO:
+    """Open a new upload batch for writing, so it can be streamed in"""
     if not _init:
         raise Exception("Buckets where not initialized. Run `init()`")
 
-    _upload_file(archive, config.UPLOAD_BATCHES_BUCKET_NAME, str(uuid))
+    return _open_file(config.UPLOAD_BATCHES_BUCKET_NAME, str(uuid))
 
 
 def get_upload_batch(uuid: UUID) -> BinaryIO:
     return _download_file(str(uuid), config.UPLOAD_BATCHES_BUCKET_NAME)
 
 
-def update_download_batch(uuid: UUID, new_archive: BinaryIO) -> None:
-    _upload_file(
-        new_archive, config.DOWNLOAD_BATCHES_BUCKET_NAME, str(uuid) + ".tar.gz"
-    )
+def delete_upload_batch(uuid: UUID) -> None:
+    _delete_file(config.UPLOAD_BATCHES_BUCKET_NAME, str(uuid))
 
 
-def get_download_batch(uuid: UUID) -> BinaryIO:
+def open_download_batch(uuid: UUID, extension: str) -> BinaryIO:
+    """Open a new download batch for writing, so it can be streamed in"""
+    if not _init:
+        raise Exception("Buckets where not initialized. Run `init()`")
+
+    return _open_file(config.DOWNLOAD_BATCHES_BUCKET_NAME, str(uuid) + extension)
+
+
+def get_download_batch_path(uuid: UUID, extension: str) -> str:
     """
-    Eventually, this needs to stream. It should look like this:
-        obj = s3.get_object(Bucket="my-bucket", Key=key)
-        body = obj["Body"]  # This is a streaming response from boto3
-
-        return StreamingResponse(
-            body,
-            media_type="application/octet-stream",
-            headers={"Content-Disposition": f"attachment; filename={key}"}
-        )
+    Where a download batch is stored on the local filesystem, so it can be
+    served with `sendfile` and byte ranges. S3 will need presigned URLs.
     """
-    return _download_file(str(uuid) + ".tar.gz", config.UPLOAD_BATCHES_BUCKET_NAME)
+    return _get_path(config.DOWNLOAD_BATCHES_BUCKET_NAME, str(uuid) + extension)
+
+
+def delete_download_batch(uuid: UUID, extension: str) -> None:
+    _delete_file(config.DOWNLOAD_BATCHES_BUCKET_NAME, str(uuid) + extension)
 
 
 def create_image(image: BinaryIO, uuid: UUID) -> None:
@@ -73,15 +78,33 @@ def get_image(uuid: UUID) -> BinaryIO:
     return _download_file(str(uuid), config.IMAGES_BUCKET_NAME)
 
 
+def delete_image(uuid: UUID) -> None:
+    _delete_file(config.IMAGES_BUCKET_NAME, str(uuid))
+
+
 def _create_s3_bucket(name: str) -> None:
     if not os.path.exists(_DATA_PATH + "/" + name):
         os.makedirs(_DATA_PATH + "/" + name)
 
 
 def _upload_file(file: BinaryIO, bucket: str, object_name: str) -> None:
-    with open(_DATA_PATH + "/" + bucket + "/" + object_name, "wb") as f:
+    with _open_file(bucket, object_name) as f:
         file.seek(0)
-        f.write(file.read())
+        shutil.copyfileobj(file, f, config.HASHING_BUF_SIZE)
+
+
+def _get_path(bucket: str, object_name: str) -> str:
+    return _DATA_PATH + "/" + bucket + "/" + object_name
+
+
+def _open_file(bucket: str, object_name: str) -> BinaryIO:
+    return open(_DATA_PATH + "/" + bucket + "/" + object_name, "wb")
+
+
+def _delete_file(bucket: str, object_name: str) -> None:
+    path = _DATA_PATH + "/" + bucket + "/" + object_name
+    if os.path.exists(path):
+        os.remove(path)
 
 
 def _download_file(object_name: str, bucket: str) -> BinaryIO:
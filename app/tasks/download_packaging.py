@@ -7,28 +7,59 @@ URL where they can download the entire file.
 
 import hashlib
 import json
+import math
 import random
+import shutil
 import tarfile
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, as_completed
+from contextlib import closing
 from datetime import datetime, timezone
-from io import BytesIO, TextIOWrapper
-from typing import Any, TypedDict
+from io import BytesIO
+from itertools import chain
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
+from typing import Any, TypedDict, TypeVar
 from uuid import UUID
 
-from sqlalchemy import ScalarResult
-from sqlmodel import Session, func, select
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from PIL import Image as PIL_Image
+from sqlalchemy import select as sql_select
+from sqlmodel import Session, col, func, or_, select, tuple_
+from sqlmodel.sql.expression import SelectOfScalar
 
 from app.core import config
-from app.core.helpers import UUIDEncoder
-from app.crud import download_batch, label_category
+from app.core.compression import (
+    CompressingWriter,
+    ParallelGzipWriter,
+    PlainWriter,
+    Writable,
+    zstd_writer,
+)
+from app.core.helpers import HashingWriter
+from app.crud import download_batch
 from app.database import engine
-from app.models.download_batch import DownloadStatus
-from app.models.image import Image
-from app.models.label_category import LabelSuperCategory
+from app.models.annotation import Annotation, ImageCategory
+from app.models.download_batch import (
+    AnnotationFormat,
+    AnnotationSelection,
+    ArchiveCompression,
+    DownloadBatch,
+    DownloadShard,
+    DownloadStatus,
+)
+from app.models.image import Image, ImageTombstone
+from app.models.label_category import LabelCategory, LabelSuperCategory
 from app.services.buckets import (
+    delete_download_batch,
     get_image,
-    update_download_batch,
+    open_download_batch,
 )
 
+T = TypeVar("T")
+
 
 class COCOLicense(TypedDict):
     url: str
@@ -43,7 +74,7 @@ class COCOCategory(TypedDict):
 
 
 class COCOImage(TypedDict):
-    id: int
+    id: str
     license: int
     width: int
     hight: int
@@ -98,169 +129,996 @@ def create_download_batch(batch_id: UUID) -> None:
             raise ValueError(f"DownloadBatch with id {batch_id} not found")
 
         try:
-            download_batch.update(
-                session, batch_id, {"status": DownloadStatus.ASSEMBLING_LABELS}
-            )
+            if batch.sharded:
+                for status in _write_shards(session, batch):
+                    if status != batch.status:
+                        download_batch.update(session, batch_id, {"status": status})
 
-            manifest = BASE_COCO_MANIFEST.copy()  # Make a copy of the manifest
-            annotation_category_id_list = []  # Store the selected ids so I don't have to loop later
-
-            for selection in batch.annotations:
-                try:
-                    if selection.super:
-                        # If the selection is super, include all children
-                        super_cat = label_category.get_super(session, selection.id)
-                        if super_cat is None:
-                            raise
-
-                        for category in super_cat.sub_categories:
-                            assert category.id
-                            manifest["categories"].append(
-                                {
-                                    "supercategory": super_cat.name,
-                                    "id": category.id,
-                                    "name": category.name,
-                                }
-                            )
-                            annotation_category_id_list.append(category.id)
-                    else:
-                        # The selection is not super, add it alone
-                        category = label_category.get(session, selection.id)  # type: ignore[assignment]
-                        if category is None or isinstance(category, LabelSuperCategory):
-                            raise
-
-                        if category.super_category:
-                            assert category.id
-                            manifest["categories"].append(
-                                {
-                                    "supercategory": category.super_category.name,
-                                    "id": category.id,
-                                    "name": category.name,
-                                }
-                            )
-                        else:
-                            assert category.id, category.name
-                            manifest["categories"].append(
-                                {
-                                    "supercategory": None,
-                                    "id": category.id,
-                                    "name": category.name,
-                                }
-                            )
-                        annotation_category_id_list.append(category.id)
-
-                except Exception:
-                    pass
-
-            download_batch.update(
-                session, batch_id, {"status": DownloadStatus.ASSEMBLING_IMAGES}
-            )
+                batch.file_size = sum(
+                    DownloadShard.model_validate(shard).file_size
+                    for shard in batch.shards or []
+                )
+            else:
+                write = _write_packed if batch.packed else _write_archive
+                extension = config.ARCHIVE_EXTENSIONS[batch.compression]
+                with open_download_batch(batch_id, extension) as archive_obj:
+                    # Hash the archive on its way into storage
+                    writer = HashingWriter(archive_obj, "sha256")
+                    for status in write(session, batch, writer):
+                        if status != batch.status:
+                            download_batch.update(session, batch_id, {"status": status})
+
+                batch.hash = writer.hexdigest()
+                batch.file_size = writer.size
+
+            batch.archive_id = batch_id
+            batch.status = DownloadStatus.READY
+            session.add(batch)
+            session.commit()
+
+        except Exception as e:
+            session.rollback()
+            for extension in _get_archive_extensions(batch):
+                delete_download_batch(batch_id, extension)
+            batch.status = DownloadStatus.FAILED
+            batch.error_message = str(e)
+            session.add(batch)
+            session.commit()
+            raise
+
+
+def use_cached_download_batch(session: Session, batch: DownloadBatch) -> bool:
+    """
+    Point `batch` at the stored archive of an identical earlier request, if
+    there is one, and mark it ready. Otherwise its fingerprint is recorded so
+    later requests can share the archive once it is built. Only seeded
+    requests are cached, since the others are meant to be a fresh sample.
+    """
+    fingerprint = get_fingerprint(session, batch)
+    if fingerprint is None:
+        return False
+
+    batch.fingerprint = fingerprint
+    cached = download_batch.get_cached(session, fingerprint)
+    if cached is not None:
+        batch.archive_id = cached.archive_id
+        batch.hash = cached.hash
+        batch.file_size = cached.file_size
+        batch.shards = cached.shards
+        # A delta carries on from wherever the archive it shares stopped
+        batch.watermark = cached.watermark
+        batch.watermark_id = cached.watermark_id
+        batch.status = DownloadStatus.READY
+
+    session.add(batch)
+    session.commit()
+    return cached is not None
+
+
+def get_fingerprint(session: Session, batch: DownloadBatch) -> str | None:
+    """
+    Hash everything that decides what goes into a batch's archive, including
+    a version of the dataset. Adding, editing or deleting an image or one of
+    its annotations bumps the image's `updated_at` or leaves a tombstone, so
+    either changes the version. Returns `None` for unseeded batches, which
+    can't be reproduced.
+    """
+    if batch.seed is None:
+        return None
+
+    latest_update = session.exec(select(func.max(Image.updated_at))).one()
+    latest_deletion = session.exec(select(func.max(ImageTombstone.deleted_at))).one()
+    selections = map(AnnotationSelection.model_validate, batch.annotations)
+
+    request = {
+        "annotations": sorted(
+            (selection.id, selection.super) for selection in selections
+        ),
+        "count": batch.image_count,
+        "non_match_images": batch.non_match_images,
+        "seed": batch.seed,
+        "splits": batch.splits,
+        "compression": batch.compression,
+        "sharded": batch.sharded,
+        "packed": batch.packed,
+        "annotation_format": batch.annotation_format,
+        "since": batch.since,
+        "since_id": batch.since_id,
+        "version": config.PROJECT_VERSION,
+        "dataset": [latest_update, latest_deletion],
+    }
+    data = json.dumps(request, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def release_download_batch(session: Session, batch: DownloadBatch) -> None:
+    """
+    Delete a batch, and its stored archive once no other batch shares it
+    """
+    archive_id = batch.archive_id
+    extensions = _get_archive_extensions(batch)
+    session.delete(batch)
+    session.commit()
+
+    if (
+        archive_id is not None
+        and download_batch.count_archive_references(session, archive_id) == 0
+    ):
+        for extension in extensions:
+            delete_download_batch(archive_id, extension)
+
+
+def get_shard_extension(index: int, extension: str) -> str:
+    """The end of a shard's file name, after the batch's id"""
+    return f"-{index:05d}{extension}"
+
+
+def _get_archive_extensions(batch: DownloadBatch) -> list[str]:
+    """The ends of the names of every file a batch's archive is stored in"""
+    extension = config.ARCHIVE_EXTENSIONS[batch.compression]
+    if not batch.sharded:
+        return [extension]
+
+    shard_count = math.ceil(batch.image_count / config.DOWNLOAD_SHARD_SIZE)
+    return [get_shard_extension(index, extension) for index in range(shard_count)]
+
+
+def sample_download_batch(session: Session, batch: DownloadBatch) -> None:
+    """
+    Pick a streamed batch's images when it is requested, so every download
+    of it has the same images, whatever is added or relabelled in between.
+    """
+    assert batch.id
+    categories = _get_categories(
+        session, map(AnnotationSelection.model_validate, batch.annotations)
+    )
+    images = _get_images(session, batch, [category["id"] for category in categories])
+    download_batch.update(
+        session,
+        batch.id,
+        {
+            "image_ids": [image.id.hex for image in images if image.id],
+            "watermark": batch.watermark,
+            "watermark_id": batch.watermark_id,
+        },
+    )
+
+
+def stream_download_batch(batch_id: UUID) -> Iterator[bytes]:
+    """
+    Build a batch's archive while it is being downloaded, without storing
+    it. Nothing is kept between downloads, so this is for small batches.
+    """
+    # Nothing is written, and loaded rows stay usable after each commit
+    with Session(engine, expire_on_commit=False) as session:
+        batch = download_batch.get(session, batch_id)
+
+        if not batch:
+            raise ValueError(f"DownloadBatch with id {batch_id} not found")
+
+        buffer = _ChunkBuffer()
+        for _ in _write_archive(session, batch, buffer):
+            # Give the connection back to the pool between queries, instead of
+            # holding it for as long as the client takes to download
+            session.commit()
+            if chunk := buffer.take():
+                yield chunk
+
+        if chunk := buffer.take():
+            yield chunk
+
+
+class _ChunkBuffer:
+    """A write-only file that holds what was written until it is taken"""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _write_archive(
+    session: Session, batch: DownloadBatch, archive_obj: Writable
+) -> Iterator[DownloadStatus]:
+    """
+    Write the batch's archive to `archive_obj` one entry at a time, so only
+    a few prefetched images are ever held in memory. Yields the current stage after
+    every step, which lets the caller report progress or flush output.
+    """
+    yield DownloadStatus.ASSEMBLING_LABELS
+
+    info = dict(BASE_COCO_MANIFEST["info"], seed=batch.seed, splits=batch.splits)
+    categories = _get_categories(
+        session, map(AnnotationSelection.model_validate, batch.annotations)
+    )
+    category_ids = [category["id"] for category in categories]
 
-            archive_obj = BytesIO()
-            with tarfile.open(fileobj=archive_obj, mode="w:gz") as archive:
-                images = _get_random_images(session, batch.image_count)
-                for image in images:
-                    assert image.id
-                    manifest["images"].append(
+    yield DownloadStatus.ASSEMBLING_IMAGES
+
+    # Stream mode only ever writes forwards, so any writable file will do
+    with (
+        closing(_open_compressor(batch.compression, archive_obj)) as compressor,
+        tarfile.open(fileobj=compressor, mode="w|") as archive,  # type: ignore[call-overload]
+        _ManifestWriter(info, categories) as manifest,
+    ):
+        coco = batch.annotation_format == AnnotationFormat.COCO
+        images = _get_images(session, batch, category_ids)
+        annotations = _get_annotations(session, images, category_ids) if coco else {}
+        image_entries: list[COCOImage] = []
+        with ThreadPoolExecutor(config.DOWNLOAD_PREFETCH_WORKERS) as pool:
+            for image, data in _prefetch_images(images, pool, _read_image):
+                assert image.id
+                file_name = str(image.id) + "." + config.IMAGE_STORAGE_FORMAT
+                if batch.splits:
+                    # Each split gets its own folder
+                    file_name = (
+                        get_split(image.id, batch.splits, batch.seed) + "/" + file_name
+                    )
+
+                entry: COCOImage = {
+                    "id": image.id.hex,
+                    "license": 0,
+                    "width": image.width or 640,
+                    "hight": image.height or 640,
+                    "file_name": file_name,
+                    "date_captured": image.created_at.strftime("%y-%m-%d %H:%M:%S"),
+                }
+                if coco:
+                    manifest.add_image(entry)
+                else:
+                    image_entries.append(entry)
+
+                tar_info = tarfile.TarInfo(name=file_name)
+                tar_info.size = len(data)
+                tar_info.mtime = image.created_at.timestamp()
+                tar_info.mode = 0o644
+
+                archive.addfile(tarinfo=tar_info, fileobj=BytesIO(data))
+
+                for annotation in annotations.get(image.id, []):
+                    manifest.add_annotation(
                         {
-                            "id": image.id,
-                            "license": 0,
-                            "width": 640,
-                            "hight": 640,
-                            "file_name": str(image.id)
-                            + "."
-                            + config.IMAGE_STORAGE_FORMAT,
-                            "date_captured": image.created_at.strftime(
-                                "%y-%m-%d %H:%M:%S"
-                            ),
+                            "id": annotation.id,
+                            "category_id": annotation.category_id,
+                            "iscrowd": annotation.iscrowd,
+                            "area": annotation.bbox_h * annotation.bbox_w,
+                            "bbox": [
+                                annotation.bbox_x,
+                                annotation.bbox_y,
+                                annotation.bbox_w,
+                                annotation.bbox_h,
+                            ],
                         }
                     )
 
-                    image_obj = get_image(image.id)
-                    image_obj.seek(0, 2)
-                    size = image_obj.tell()
-                    image_obj.seek(0)
+                yield DownloadStatus.ASSEMBLING_IMAGES
 
-                    tar_info = tarfile.TarInfo(
-                        name=str(image.id) + "." + config.IMAGE_STORAGE_FORMAT
-                    )
-                    tar_info.size = size
-                    tar_info.mtime = image.created_at.timestamp()
-                    tar_info.mode = 0o644
-
-                    archive.addfile(tarinfo=tar_info, fileobj=image_obj)
-
-                    for annotation in image.annotations:
-                        if annotation.category_id in annotation_category_id_list:
-                            manifest["annotations"].append(
-                                {
-                                    "id": annotation.id,
-                                    "category_id": annotation.category_id,
-                                    "iscrowd": annotation.iscrowd,
-                                    "area": annotation.bbox_h * annotation.bbox_w,
-                                    "bbox": [
-                                        annotation.bbox_x,
-                                        annotation.bbox_y,
-                                        annotation.bbox_w,
-                                        annotation.bbox_h,
-                                    ],
-                                }
-                            )
-
-                download_batch.update(
-                    session, batch_id, {"status": DownloadStatus.ADDING_MANIFEST}
-                )
+        yield DownloadStatus.ADDING_MANIFEST
 
-                manifest_obj = BytesIO()
-                with TextIOWrapper(
-                    manifest_obj, encoding="utf-8", write_through=True
-                ) as wrapper:
-                    json.dump(manifest, wrapper, cls=UUIDEncoder)
+        if batch.since is not None:
+            _add_file(
+                archive,
+                "deleted.json",
+                json.dumps(_get_deleted_images(session, batch.since)).encode(),
+                datetime.now(timezone.utc).timestamp(),
+            )
 
-                manifest_obj.seek(0)
+        if not coco:
+            _add_columnar_labels(
+                session, archive, batch.annotation_format, image_entries, categories
+            )
+            return
 
-                tar_info = tarfile.TarInfo(name="manifest.json")
+        manifest_obj = manifest.finish()
+        tar_info = tarfile.TarInfo(name="manifest.json")
+        tar_info.size = manifest_obj.tell()
+        manifest_obj.seek(0)  # Rewind for reading
 
-                manifest_obj.seek(0, 2)  # Move to end to get size
-                tar_info.size = manifest_obj.tell()
-                manifest_obj.seek(0)  # Rewind for reading
+        tar_info.mtime = datetime.now(timezone.utc).timestamp()  # type: ignore[assignment]
+        tar_info.mode = 0o644
 
-                tar_info.mtime = datetime.now(timezone.utc).timestamp()  # type: ignore[assignment]
-                tar_info.mode = 0o644
+        archive.addfile(tarinfo=tar_info, fileobj=manifest_obj)
 
-                archive.addfile(tarinfo=tar_info, fileobj=manifest_obj)
 
-            archive_obj.seek(0)
-            update_download_batch(batch_id, archive_obj)
+class _ManifestWriter:
+    """
+    Writes a COCO manifest one entry at a time, with the same layout as
+    `json.dump` of the whole `COCOManifest`. Images and annotations are
+    spooled to their own temporary files as they are added, so only the
+    entry being written is held as Python objects. Ids must already be
+    plain JSON types, which keeps `json.dumps` on its cached C encoder.
+    """
 
-            archive_obj.seek(0)
-            batch.hash = hashlib.sha256(archive_obj.read()).hexdigest()
+    def __init__(self, info: dict[str, Any], categories: list[COCOCategory]) -> None:
+        self.info = info
+        self.categories = categories
+        self._images = SpooledTemporaryFile(config.MANIFEST_SPOOL_SIZE)
+        self._annotations = SpooledTemporaryFile(config.MANIFEST_SPOOL_SIZE)
 
-            batch.status = DownloadStatus.READY
-            session.add(batch)
-            session.commit()
+    def __enter__(self) -> "_ManifestWriter":
+        return self
 
-        except Exception as e:
-            session.rollback()
-            batch.status = DownloadStatus.FAILED
-            batch.error_message = str(e)
+    def __exit__(self, *args: object) -> None:
+        self._images.close()
+        self._annotations.close()
+
+    def add_image(self, image: COCOImage) -> None:
+        self._add(self._images, image)
+
+    def add_annotation(self, annotation: COCOAnnotations) -> None:
+        self._add(self._annotations, annotation)
+
+    def finish(self) -> SpooledTemporaryFile[bytes]:
+        """
+        Join everything into one file and return it, positioned at its end.
+        It is closed when the writer is.
+        """
+        head = {"info": self.info, "licenses": BASE_COCO_MANIFEST["licenses"]}
+        prefix = json.dumps(head)[:-1] + ', "images": ['
+
+        manifest = SpooledTemporaryFile(config.MANIFEST_SPOOL_SIZE)
+        manifest.write(prefix.encode())
+        self._images.seek(0)
+        shutil.copyfileobj(self._images, manifest)
+        manifest.write(b'], "annotations": [')
+        self._annotations.seek(0)
+        shutil.copyfileobj(self._annotations, manifest)
+        manifest.write(b'], "categories": ' + json.dumps(self.categories).encode())
+        manifest.write(b"}")
+
+        # Swap it in so it's closed with the others
+        self._images.close()
+        self._images = manifest
+        return manifest
+
+    @staticmethod
+    def _add(file: SpooledTemporaryFile[bytes], entry: Mapping[str, Any]) -> None:
+        if file.tell():
+            file.write(b", ")
+        file.write(json.dumps(entry).encode())
+
+
+_IMAGE_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("file_name", pa.string()),
+        ("width", pa.int32()),
+        ("height", pa.int32()),
+        ("date_captured", pa.string()),
+    ]
+)
+_ANNOTATION_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("image_id", pa.string()),
+        ("category_id", pa.int32()),
+        ("bbox", pa.list_(pa.int32(), 4)),  # x, y, w, h
+        ("iscrowd", pa.bool_()),
+    ]
+)
+_CATEGORY_SCHEMA = pa.schema(
+    [("id", pa.int32()), ("name", pa.string()), ("supercategory", pa.string())]
+)
+_COLUMNAR_EXTENSIONS = {
+    AnnotationFormat.PARQUET: ".parquet",
+    AnnotationFormat.ARROW: ".arrow",
+}
+
+
+def _add_columnar_labels(
+    session: Session,
+    archive: tarfile.TarFile,
+    annotation_format: AnnotationFormat,
+    images: list[COCOImage],
+    categories: list[COCOCategory],
+) -> None:
+    """
+    Add the labels as `images`, `annotations` and `categories` tables in
+    Parquet or Arrow IPC files, which can be memory-mapped and filtered
+    without parsing JSON. Annotations are fed to the writer in record
+    batches straight from a column query, without loading any models.
+    """
+    extension = _COLUMNAR_EXTENSIONS[annotation_format]
+    with TemporaryDirectory() as directory:
+        tables = {
+            "images": pa.Table.from_pylist(
+                # The COCO manifest spells it `hight`
+                [dict(image, height=image["hight"]) for image in images],
+                schema=_IMAGE_SCHEMA,
+            ),
+            "categories": pa.Table.from_pylist(categories, schema=_CATEGORY_SCHEMA),
+        }
+        for name, table in tables.items():
+            with _open_table_writer(
+                directory + "/" + name + extension, table.schema, annotation_format
+            ) as writer:
+                writer.write_table(table)
+
+        with _open_table_writer(
+            directory + "/annotations" + extension,
+            _ANNOTATION_SCHEMA,
+            annotation_format,
+        ) as writer:
+            category_ids = [category["id"] for category in categories]
+            image_ids = [UUID(image["id"]) for image in images]
+            for record_batch in _get_annotation_batches(
+                session, image_ids, category_ids
+            ):
+                writer.write_batch(record_batch)
+
+        for name in ("images", "annotations", "categories"):
+            archive.add(directory + "/" + name + extension, arcname=name + extension)
+
+
+def _open_table_writer(
+    path: str, schema: pa.Schema, annotation_format: AnnotationFormat
+) -> pq.ParquetWriter | pa.RecordBatchFileWriter:
+    if annotation_format == AnnotationFormat.PARQUET:
+        return pq.ParquetWriter(path, schema)
+    return pa.ipc.new_file(path, schema)
+
+
+def _get_annotation_batches(
+    session: Session, image_ids: list[UUID], category_ids: list[int]
+) -> Iterator[pa.RecordBatch]:
+    if not image_ids or not category_ids:
+        return
+
+    result = session.execute(
+        sql_select(
+            col(Annotation.id),
+            col(Annotation.image_id),
+            col(Annotation.category_id),
+            col(Annotation.bbox_x),
+            col(Annotation.bbox_y),
+            col(Annotation.bbox_w),
+            col(Annotation.bbox_h),
+            col(Annotation.iscrowd),
+        )
+        .where(col(Annotation.image_id).in_(image_ids))
+        .where(col(Annotation.category_id).in_(category_ids))
+        .order_by(col(Annotation.id))
+        .execution_options(yield_per=config.COLUMNAR_BATCH_SIZE)
+    )
+    for rows in result.partitions():
+        ids, image_id, category_id, x, y, w, h, iscrowd = zip(*rows, strict=True)
+        bbox = [value for box in zip(x, y, w, h, strict=True) for value in box]
+        yield pa.record_batch(
+            [
+                pa.array(ids, pa.int64()),
+                pa.array([i.hex for i in image_id], pa.string()),
+                pa.array(category_id, pa.int32()),
+                pa.FixedSizeListArray.from_arrays(pa.array(bbox, pa.int32()), 4),
+                pa.array(iscrowd, pa.bool_()),
+            ],
+            schema=_ANNOTATION_SCHEMA,
+        )
+
+
+def _write_packed(
+    session: Session, batch: DownloadBatch, archive_obj: Writable
+) -> Iterator[DownloadStatus]:
+    """
+    Write the batch as arrays a training job can `np.load(mmap_mode="r")`
+    with no per-image decoding. `images.npy` holds every image's pixels as
+    uint8, shaped (N, size, size, 3), and row i of `ids.npy` is the id of
+    image i. Each row of `labels.npy` is one annotation: the image's index,
+    category id, bbox x, y, w, h and iscrowd. Images are decoded on the
+    prefetch threads and streamed into the archive as they arrive.
+    """
+    yield DownloadStatus.ASSEMBLING_LABELS
+
+    categories = _get_categories(
+        session, map(AnnotationSelection.model_validate, batch.annotations)
+    )
+
+    yield DownloadStatus.ASSEMBLING_IMAGES
+
+    category_ids = [category["id"] for category in categories]
+    images = _get_images(session, batch, category_ids)
+    annotations = _get_annotations(session, images, category_ids)
+    image_ids = [image.id for image in images]
+
+    labels = np.array(
+        [
+            (
+                index,
+                annotation.category_id,
+                annotation.bbox_x or 0,
+                annotation.bbox_y or 0,
+                annotation.bbox_w or 0,
+                annotation.bbox_h or 0,
+                annotation.iscrowd,
+            )
+            for index, image_id in enumerate(image_ids)
+            for annotation in annotations.get(image_id, [])  # type: ignore[arg-type]
+        ],
+        dtype=np.int32,
+    ).reshape(-1, 7)
+
+    mtime = datetime.now(timezone.utc).timestamp()
+    with (
+        closing(_open_compressor(batch.compression, archive_obj)) as compressor,
+        tarfile.open(fileobj=compressor, mode="w|") as archive,  # type: ignore[call-overload]
+        ThreadPoolExecutor(config.DOWNLOAD_PREFETCH_WORKERS) as pool,
+    ):
+        size = config.PACKED_IMAGE_SIZE
+        pixels = _prefetch_images(images, pool, _read_pixels)
+        _add_array_stream(
+            archive,
+            "images.npy",
+            (len(images), size, size, 3),
+            np.dtype(np.uint8),
+            (data for _, data in pixels),
+            mtime,
+        )
+
+        yield DownloadStatus.ADDING_MANIFEST
+
+        ids = np.array([i.hex for i in image_ids if i], dtype="U32")
+        for name, array in (("ids.npy", ids), ("labels.npy", labels)):
+            buffer = BytesIO()
+            np.save(buffer, array)
+            _add_file(archive, name, buffer.getvalue(), mtime)
+
+        _add_file(archive, "categories.json", json.dumps(categories).encode(), mtime)
+        if batch.since is not None:
+            deleted = _get_deleted_images(session, batch.since)
+            _add_file(archive, "deleted.json", json.dumps(deleted).encode(), mtime)
+
+
+def _add_array_stream(
+    archive: tarfile.TarFile,
+    name: str,
+    shape: tuple[int, ...],
+    dtype: np.dtype,
+    chunks: Iterator[bytes],
+    mtime: float,
+) -> None:
+    """Add an `.npy` file whose data is written from `chunks` as they come"""
+    header = BytesIO()
+    np.lib.format.write_array_header_1_0(
+        header,
+        {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": False,
+            "shape": shape,
+        },
+    )
+
+    tar_info = tarfile.TarInfo(name=name)
+    tar_info.size = header.tell() + math.prod(shape) * dtype.itemsize
+    tar_info.mtime = mtime
+    tar_info.mode = 0o644
+    archive.addfile(
+        tarinfo=tar_info, fileobj=_IteratorReader(chain([header.getvalue()], chunks))
+    )
+
+
+class _IteratorReader:
+    """A read-only file over an iterator of byte strings"""
+
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self._chunks = chunks
+        self._buffer = bytearray()
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class _Sample(TypedDict):
+    id: UUID
+    name: str
+    mtime: float
+    labels: bytes
+
+
+def _write_shards(session: Session, batch: DownloadBatch) -> Iterator[DownloadStatus]:
+    """
+    Write the batch as tar shards of `DOWNLOAD_SHARD_SIZE` images, laid out
+    the way WebDataset expects: each image sits next to a JSON file of its
+    labels. Shards are written in parallel, and each one is listed on the
+    batch as soon as it is stored, so it can be downloaded while the rest
+    are still being built.
+    """
+    assert batch.id
+    yield DownloadStatus.ASSEMBLING_LABELS
+
+    categories = {
+        category["id"]: category
+        for category in _get_categories(
+            session, map(AnnotationSelection.model_validate, batch.annotations)
+        )
+    }
+
+    yield DownloadStatus.ASSEMBLING_IMAGES
+
+    images = _get_images(session, batch, list(categories))
+    annotations = _get_annotations(session, images, list(categories))
+
+    # Shards are written on other threads, so they only get plain data
+    samples: list[_Sample] = []
+    for image in images:
+        assert image.id
+        name = str(image.id)
+        if batch.splits:
+            name = get_split(image.id, batch.splits, batch.seed) + "/" + name
+
+        labels = {
+            "id": image.id.hex,
+            "width": image.width or 640,
+            "height": image.height or 640,
+            "annotations": [
+                {
+                    "id": annotation.id,
+                    "category_id": annotation.category_id,
+                    "category": categories[annotation.category_id]["name"],
+                    "supercategory": categories[annotation.category_id][
+                        "supercategory"
+                    ],
+                    "iscrowd": annotation.iscrowd,
+                    "area": annotation.bbox_h * annotation.bbox_w,  # type: ignore[operator]
+                    "bbox": [
+                        annotation.bbox_x,
+                        annotation.bbox_y,
+                        annotation.bbox_w,
+                        annotation.bbox_h,
+                    ],
+                }
+                for annotation in annotations.get(image.id, [])
+            ],
+        }
+        samples.append(
+            {
+                "id": image.id,
+                "name": name,
+                "mtime": image.created_at.timestamp(),  # type: ignore[union-attr]
+                "labels": json.dumps(labels).encode(),
+            }
+        )
+
+    # Delta batches list removed images in the first shard, which is written
+    # even if nothing else changed
+    extra_files = {}
+    if batch.since is not None:
+        deleted = _get_deleted_images(session, batch.since)
+        extra_files["deleted.json"] = json.dumps(deleted).encode()
+
+    shards: list[DownloadShard] = []
+    with ThreadPoolExecutor(config.DOWNLOAD_SHARD_WORKERS) as pool:
+        futures = [
+            pool.submit(
+                _write_shard,
+                batch.id,
+                index,
+                samples[start : start + config.DOWNLOAD_SHARD_SIZE],
+                batch.compression,
+                extra_files if index == 0 else {},
+            )
+            for index, start in enumerate(
+                range(0, max(len(samples), 1), config.DOWNLOAD_SHARD_SIZE)
+            )
+        ]
+        for future in as_completed(futures):
+            shards.append(future.result())
+            shards.sort(key=lambda shard: shard.index)
+
+            batch.shards = [shard.model_dump() for shard in shards]  # type: ignore[misc]
             session.add(batch)
             session.commit()
-            raise
+            yield DownloadStatus.ASSEMBLING_IMAGES
 
 
-def _get_random_images(session: Session, count: int) -> ScalarResult[Image] | list:
-    # First, get the total count
-    total_images = session.exec(select(func.count()).select_from(Image)).one()
+def _write_shard(
+    batch_id: UUID,
+    index: int,
+    samples: list[_Sample],
+    compression: ArchiveCompression,
+    extra_files: dict[str, bytes],
+) -> DownloadShard:
+    extension = get_shard_extension(index, config.ARCHIVE_EXTENSIONS[compression])
+    with open_download_batch(batch_id, extension) as shard_obj:
+        writer = HashingWriter(shard_obj, "sha256")
+        threads = max(1, config.COMPRESSION_THREADS // config.DOWNLOAD_SHARD_WORKERS)
+        with (
+            closing(_open_compressor(compression, writer, threads)) as compressor,
+            tarfile.open(fileobj=compressor, mode="w|") as shard,  # type: ignore[call-overload]
+        ):
+            for sample in samples:
+                name, mtime = sample["name"], sample["mtime"]
+                image_name = name + "." + config.IMAGE_STORAGE_FORMAT
+                _add_file(shard, image_name, _read_image(sample["id"]), mtime)
+                _add_file(shard, name + ".json", sample["labels"], mtime)
 
-    if total_images == 0:
+            for name, data in extra_files.items():
+                _add_file(shard, name, data, datetime.now(timezone.utc).timestamp())
+
+    return DownloadShard(
+        index=index,
+        image_count=len(samples),
+        hash=writer.hexdigest(),
+        file_size=writer.size,
+    )
+
+
+def _add_file(archive: tarfile.TarFile, name: str, data: bytes, mtime: float) -> None:
+    tar_info = tarfile.TarInfo(name=name)
+    tar_info.size = len(data)
+    tar_info.mtime = mtime
+    tar_info.mode = 0o644
+    archive.addfile(tarinfo=tar_info, fileobj=BytesIO(data))
+
+
+def _get_categories(
+    session: Session, selections: Iterable[AnnotationSelection]
+) -> list[COCOCategory]:
+    """
+    Resolve a batch's selections to manifest categories in one query. A super
+    selection stands for all of its children.
+    """
+    category_ids: list[int] = []
+    super_ids: list[int] = []
+    for selection in selections:
+        (super_ids if selection.super else category_ids).append(selection.id)
+
+    if not category_ids and not super_ids:
         return []
 
-    # Calculate a random offset, making sure we don't go out of bounds
-    max_offset = max(0, total_images - count)
-    offset = random.randint(0, max_offset)
+    rows = session.exec(
+        select(LabelCategory, LabelSuperCategory.name)
+        .outerjoin(
+            LabelSuperCategory,
+            col(LabelCategory.super_category_id) == LabelSuperCategory.id,
+        )
+        .where(
+            or_(
+                col(LabelCategory.id).in_(category_ids),
+                col(LabelCategory.super_category_id).in_(super_ids),
+            )
+        )
+        .order_by(col(LabelCategory.id))
+    )
+
+    categories: list[COCOCategory] = []
+    for category, super_name in rows:
+        assert category.id
+        categories.append(
+            {"supercategory": super_name, "id": category.id, "name": category.name}
+        )
+    return categories
+
+
+def _get_annotations(
+    session: Session, images: list[Image], category_ids: list[int]
+) -> dict[UUID, list[Annotation]]:
+    """
+    Load the annotations in the selected categories for every image in the
+    sample with one query, grouped by image.
+    """
+    if not images or not category_ids:
+        return {}
+
+    annotations: dict[UUID, list[Annotation]] = {}
+    for annotation in session.exec(
+        select(Annotation)
+        .where(col(Annotation.image_id).in_([image.id for image in images]))
+        .where(col(Annotation.category_id).in_(category_ids))
+        .order_by(col(Annotation.id))
+    ):
+        annotations.setdefault(annotation.image_id, []).append(annotation)
+    return annotations
+
+
+def _open_compressor(
+    compression: ArchiveCompression,
+    file: Writable,
+    threads: int = config.COMPRESSION_THREADS,
+) -> CompressingWriter:
+    if compression == ArchiveCompression.GZIP:
+        return ParallelGzipWriter(
+            file, config.ARCHIVE_GZIP_LEVEL, threads, config.ARCHIVE_BLOCK_SIZE
+        )
+    if compression == ArchiveCompression.ZSTD:
+        return zstd_writer(file, config.ARCHIVE_ZSTD_LEVEL, threads)
+    return PlainWriter(file)
+
+
+def _read_image(image_id: UUID) -> bytes:
+    with get_image(image_id) as image_obj:
+        return image_obj.read()
+
+
+def _read_pixels(image_id: UUID) -> bytes:
+    """Decode an image to packed RGB pixels at `PACKED_IMAGE_SIZE`"""
+    size = (config.PACKED_IMAGE_SIZE, config.PACKED_IMAGE_SIZE)
+    with get_image(image_id) as image_obj, PIL_Image.open(image_obj) as image:
+        rgb = image.convert("RGB")
+        if rgb.size != size:
+            rgb = rgb.resize(size)
+        return np.asarray(rgb, dtype=np.uint8).tobytes()
+
+
+def _prefetch_images(
+    images: Iterable[Image],
+    pool: Executor,
+    read: Callable[[UUID], T],
+) -> Iterator[tuple[Image, T]]:
+    """
+    Fetch image files from storage with `read` on `pool` while earlier ones
+    are being written, yielding each image with its data in order. At most
+    `DOWNLOAD_PREFETCH_COUNT` images are held at once.
+    """
+    pending: deque[tuple[Image, Future[T]]] = deque()
+
+    for image in images:
+        assert image.id
+        pending.append((image, pool.submit(read, image.id)))
+
+        if len(pending) >= config.DOWNLOAD_PREFETCH_COUNT:
+            image, future = pending.popleft()
+            yield image, future.result()
+
+    while pending:
+        image, future = pending.popleft()
+        yield image, future.result()
+
+
+def get_split(image_id: UUID, splits: dict[str, float], seed: int | None) -> str:
+    """
+    Pick an image's split from a hash of its id, so an image always lands in
+    the same split for the same seed, whatever else is in the sample.
+    """
+    digest = hashlib.blake2b(
+        f"{seed or 0}:{image_id.hex}".encode(), digest_size=8
+    ).digest()
+    position = int.from_bytes(digest, "big") / 2**64
+
+    total = 0.0
+    for name, ratio in splits.items():
+        total += ratio
+        if position < total:
+            return name
+    return name  # Only reached through rounding, so it belongs to the last one
+
+
+def _get_images(
+    session: Session, batch: DownloadBatch, category_ids: list[int]
+) -> list[Image]:
+    """
+    The images that go into a batch: a random sample, or for delta batches,
+    the images created or changed after `since` (and `since_id`), walked on
+    the `updated_at` index. Unless the batch asks for non-matching images,
+    only images with an annotation in `category_ids` are drawn. The batch's
+    watermark is set to where the next delta should start. Streamed batches
+    already have their sample, and keep the watermark they got with it.
+    """
+    if batch.image_ids is not None:
+        return _get_sampled_images(session, batch.image_ids)
+
+    query = select(Image)
+    if not batch.non_match_images:
+        query = query.where(col(Image.id).in_(_get_member_ids(category_ids)))
+
+    batch.watermark, batch.watermark_id = batch.start_time, None
+    if batch.since is None:
+        return _get_random_images(session, query, batch.image_count, batch.seed)
+
+    if batch.since_id is None:
+        query = query.where(col(Image.updated_at) > batch.since)
+    else:
+        query = query.where(
+            tuple_(col(Image.updated_at), col(Image.id))
+            > tuple_(batch.since, batch.since_id)
+        )
+    query = query.order_by(col(Image.updated_at), col(Image.id))
+    images = list(session.exec(query.limit(batch.image_count)))
+
+    # A full batch may have left changes out, so the next one picks up after
+    # its last image, even if others were changed at the same time
+    if len(images) == batch.image_count:
+        batch.watermark, batch.watermark_id = images[-1].updated_at, images[-1].id
+    return images
+
+
+def _get_sampled_images(session: Session, image_ids: list[str]) -> list[Image]:
+    """
+    A streamed batch's images, in the order they were sampled. Images
+    deleted since then are left out.
+    """
+    ids = [UUID(image_id) for image_id in image_ids]
+    images = {
+        image.id: image
+        for image in session.exec(select(Image).where(col(Image.id).in_(ids)))
+    }
+    return [images[image_id] for image_id in ids if image_id in images]
+
+
+def _get_member_ids(category_ids: list[int]) -> SelectOfScalar[UUID]:
+    """A subquery of the images with an annotation in any of `category_ids`"""
+    return select(ImageCategory.image_id).where(
+        col(ImageCategory.category_id).in_(category_ids)
+    )
+
+
+def _get_deleted_images(session: Session, since: datetime) -> list[str]:
+    """The ids of images deleted after `since`"""
+    return [
+        image_id.hex
+        for image_id in session.exec(
+            select(ImageTombstone.image_id).where(
+                col(ImageTombstone.deleted_at) > since
+            )
+        )
+    ]
+
+
+def _get_random_images(
+    session: Session, query: SelectOfScalar[Image], count: int, seed: int | None
+) -> list[Image]:
+    """
+    Sample `count` images from `query` by walking the `sample_key` index in
+    short runs from `DOWNLOAD_SAMPLE_RUNS` random points. Keys are assigned
+    at random, so this only ever touches about `count` index entries. A
+    single run would always hand out the same neighbours together, where
+    several runs mix them. Giving a `seed` fixes the starting points, so the
+    same images come back while the table is unchanged.
+    """
+    rng = random.Random(seed)
+    runs = min(count, config.DOWNLOAD_SAMPLE_RUNS)
+    images: dict[UUID | None, Image] = {}
+    for _ in range(runs):
+        for image in _walk_sample_keys(session, query, rng.random(), count // runs):
+            images.setdefault(image.id, image)
+
+    # Runs can overlap, and don't add up to `count` when it isn't a multiple
+    # of them. Walking past as many images as were already drawn makes sure
+    # the rest is found, if the query has that many.
+    if len(images) < count:
+        for image in _walk_sample_keys(session, query, rng.random(), count):
+            images.setdefault(image.id, image)
+            if len(images) == count:
+                break
+
+    return list(images.values())
+
+
+def _walk_sample_keys(
+    session: Session, query: SelectOfScalar[Image], start: float, count: int
+) -> list[Image]:
+    """
+    The first `count` images from `start` in `sample_key` order, wrapping
+    around to the start of the range if it runs out
+    """
+    images = list(
+        session.exec(
+            query.where(col(Image.sample_key) >= start)
+            .order_by(col(Image.sample_key))
+            .limit(count)
+        )
+    )
 
-    # Fetch `count` images starting from the offset
-    images = session.exec(select(Image).offset(offset).limit(count))
+    if len(images) < count:
+        images += session.exec(
+            query.where(col(Image.sample_key) < start)
+            .order_by(col(Image.sample_key))
+            .limit(count - len(images))
+        )
 
     return images
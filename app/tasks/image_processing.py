@@ -1,8 +1,13 @@
+import hashlib
 import tarfile
+import time
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
 from datetime import datetime, timezone
 from io import BytesIO
 from pathlib import Path
-from typing import IO, BinaryIO
+from typing import TypedDict
 from uuid import UUID
 
 from PIL import Image as PIL_Image
@@ -14,7 +19,16 @@ from app.crud import upload_batch
 from app.database import engine
 from app.models.image import ImageCreate
 from app.models.upload_batch import UploadBatch, UploadStatus
-from app.services.buckets import create_image, get_upload_batch
+from app.models.user import User
+from app.services.buckets import create_image, delete_image, get_upload_batch
+
+
+class ProcessedImage(TypedDict):
+    data: bytes
+    width: int
+    height: int
+    file_size: int
+    hash: str
 
 
 async def process_batch_async(batch_id: UUID) -> None:
@@ -22,6 +36,10 @@ async def process_batch_async(batch_id: UUID) -> None:
         batch = upload_batch.get(session, batch_id)  # Get the batch
         if not batch:
             raise ValueError(f"UploadBatch with id {batch_id} not found")
+        user = batch.user
+
+        # If a previous run was interrupted, carry on from its checkpoint
+        progress = UploadProgress(batch)
 
         # Update the status and time to show that we have started
         upload_batch.update(
@@ -29,73 +47,48 @@ async def process_batch_async(batch_id: UUID) -> None:
             batch_id,
             {
                 "status": UploadStatus.PROCESSING,
-                "start_time": datetime.now(timezone.utc),
+                "start_time": batch.start_time or datetime.now(timezone.utc),
+                "error_message": None,
             },
         )
 
+        session.commit()  # Release the connection while we work
+
         try:
             file = get_upload_batch(batch_id)  # Get the actual file
-            with tarfile.open(fileobj=file, mode="r:gz") as tar:
-                image_files = [  # Get all the valid images in the archive
-                    m for m in tar.getmembers() if m.isfile()
-                ]
-                # Update the # of total images
-                upload_batch.update(
-                    session, batch_id, {"images_total": len(image_files)}
-                )
-
-                # Loop through every image
-                for member in image_files:
-                    try:
-                        if not validate_image_pre(member):
-                            upload_batch.update(
-                                session,
-                                batch_id,
-                                {"images_rejected": batch.images_rejected + 1},
-                            )
-                            continue  # Stop the loop here and start the next image
-
-                        image = tar.extractfile(member)  # Extract the image
-                        assert image  # The image has to exist
+            # Stream the archive so it is only decompressed once, front to back
+            with tarfile.open(fileobj=file, mode="r|gz") as tar:
+                # Validate and re-encode in the pool, handling results in order
+                accepted: list[ProcessedImage] = []  # Valid images waiting to be stored
+                with ProcessPoolExecutor(max_workers=config.INGEST_WORKERS) as pool:
+                    position = progress.position
+                    members = _ingest_members(tar, pool, skip=position)
+                    for position, future in members:
+                        image = future.result() if future else None
+                        if image is None:
+                            # The image is not valid
+                            progress.add(rejected=1)
+                        else:
+                            accepted.append(image)
+                            if len(accepted) < config.IMAGE_INSERT_CHUNK_SIZE:
+                                continue  # Keep going until the chunk is full
 
-                        # Validate the image and add it to the database
-                        if validate_image(image):
-                            image_entry = image_crud.create(
-                                session, ImageCreate(batch=batch_id), batch.user
+                            _store_images(
+                                session, batch_id, user, accepted, progress, position
                             )
+                            accepted = []
+                            continue
 
-                            image = _force_image_format(image)
+                        if not accepted:
+                            # Everything up to here is stored, so it is safe to save
+                            progress.checkpoint(session, position)
 
-                            assert (
-                                image_entry.id
-                            )  # The ID is generated, so we assume it exists
-                            create_image(image, image_entry.id)  # Add the image to S3
+                    _store_images(session, batch_id, user, accepted, progress, position)
 
-                            # Increment the valid image count
-                            upload_batch.update(
-                                session,
-                                batch_id,
-                                {"images_valid": batch.images_valid + 1},
-                            )
+            # Now that we have seen every member, record the # of total images
+            upload_batch.update(session, batch_id, {"images_total": progress.total})
 
-                        else:
-                            # The image is not valid
-                            upload_batch.update(
-                                session,
-                                batch_id,
-                                {"images_rejected": batch.images_rejected + 1},
-                            )
-
-                    except Exception:
-                        # Something went wrong somewhere, and the image is passed
-                        upload_batch.update(
-                            session,
-                            batch_id,
-                            {"images_rejected": batch.images_rejected + 1},
-                        )
-                        raise
-
-            if batch.images_valid == 0:
+            if progress.valid + progress.deduplicated == 0:
                 # If we made it through all images, but they
                 # all failed, the batch is a failure.
                 upload_batch.update(session, batch_id, {"status": UploadStatus.FAILED})
@@ -106,7 +99,8 @@ async def process_batch_async(batch_id: UUID) -> None:
                 )
 
         except Exception as e:
-            # Something went wrong, so we rollback and say we failed
+            # Something went wrong, so we rollback and say we failed. Work up
+            # to the last checkpoint is kept, so the batch can be run again.
             session.rollback()
             upload_batch.update(
                 session,
@@ -118,21 +112,184 @@ async def process_batch_async(batch_id: UUID) -> None:
             session.commit()
 
 
-def _force_image_format(image: BinaryIO | IO[bytes]) -> BytesIO:
-    with PIL_Image.open(image) as img:
-        output = BytesIO()
-        img.save(output, format=config.IMAGE_STORAGE_FORMAT)
-        output.seek(0)
-        return output
+class UploadProgress:
+    """
+    Counts valid, rejected and deduplicated images in memory. At a
+    checkpoint (a member position where every earlier image is stored)
+    the counts are written as atomic increments along with the position,
+    at most every `UPLOAD_PROGRESS_FLUSH_SECONDS` or
+    `UPLOAD_PROGRESS_FLUSH_COUNT` images, and always after a chunk of images
+    is stored. Each write commits, so no connection is held between flushes.
+    """
+
+    def __init__(self, batch: UploadBatch) -> None:
+        assert batch.id
+        self.batch_id = batch.id
+        self.valid = batch.images_valid
+        self.rejected = batch.images_rejected
+        self.deduplicated = batch.images_deduplicated
+        self.position = batch.checkpoint
+        self._pending = self._empty()
+        self._last_flush = time.monotonic()
+
+    @property
+    def total(self) -> int:
+        return self.valid + self.rejected + self.deduplicated
+
+    def add(self, valid: int = 0, rejected: int = 0, deduplicated: int = 0) -> None:
+        self.valid += valid
+        self.rejected += rejected
+        self.deduplicated += deduplicated
+        self._pending["images_valid"] += valid
+        self._pending["images_rejected"] += rejected
+        self._pending["images_deduplicated"] += deduplicated
+
+    def checkpoint(self, session: Session, position: int, force: bool = False) -> None:
+        """Mark every member before `position` as done, flushing if it is time"""
+        self.position = position
+        if (
+            force
+            or sum(self._pending.values()) >= config.UPLOAD_PROGRESS_FLUSH_COUNT
+            or time.monotonic() - self._last_flush
+            >= config.UPLOAD_PROGRESS_FLUSH_SECONDS
+        ):
+            upload_batch.increment(
+                session, self.batch_id, self._pending, checkpoint=position
+            )
+            self._pending = self._empty()
+            self._last_flush = time.monotonic()
+
+    @staticmethod
+    def _empty() -> dict[str, int]:
+        return {"images_valid": 0, "images_rejected": 0, "images_deduplicated": 0}
 
 
-def validate_image(image_path: BinaryIO | IO[bytes]) -> bool:
-    """Validate image meets requirements (640x640, etc.)"""
+def _store_images(
+    session: Session,
+    batch_id: UUID,
+    user: User,
+    images: list[ProcessedImage],
+    progress: UploadProgress,
+    position: int,
+) -> None:
+    """
+    Add a chunk of accepted images to the database and S3, and commit them
+    together with a checkpoint at `position`. Images that are already stored
+    (by hash) are counted as deduplicated. If anything fails before the
+    commit, the files written so far are deleted again, since their rows are
+    rolled back and a resumed run stores them under new ids.
+    """
+    ids = image_crud.create_many(
+        session,
+        [
+            ImageCreate(
+                batch=batch_id,
+                width=image["width"],
+                height=image["height"],
+                file_size=image["file_size"],
+                hash=image["hash"],
+            )
+            for image in images
+        ],
+        user,
+    )
+
+    stored: list[UUID] = []
+    try:
+        for image, image_id in zip(images, ids, strict=True):
+            if image_id is None:
+                continue  # A duplicate of an image we already have
+
+            stored.append(image_id)
+            create_image(BytesIO(image["data"]), image_id)  # Add the image to S3
+
+        progress.add(valid=len(stored), deduplicated=len(images) - len(stored))
+        progress.checkpoint(session, position, force=True)
+    except Exception:
+        for image_id in stored:
+            delete_image(image_id)
+        raise
+
+
+def _ingest_members(
+    tar: tarfile.TarFile, pool: Executor, skip: int = 0
+) -> Iterator[tuple[int, "Future[ProcessedImage | None] | None"]]:
+    """
+    Read file members from `tar` in a single forward pass and hand them to
+    `pool`, yielding each member's position (counting from 1) and future in
+    archive order. The first `skip` file members are passed over without
+    being extracted. Members that fail `validate_image_pre` get `None`
+    instead of a future. Only a couple of members per worker are in flight
+    at once, so memory stays bounded no matter how large the archive is.
+    """
+    max_pending = config.INGEST_WORKERS * 2
+    pending: deque[tuple[int, Future[ProcessedImage | None] | None]] = deque()
+    position = 0
+
+    for member in tar:
+        # Don't keep every header we have already read
+        tar.members = []  # type: ignore[attr-defined]
+        if not member.isfile():
+            continue
+
+        position += 1
+        if position <= skip:
+            continue  # Already handled by an earlier run
+
+        if validate_image_pre(member):
+            image = tar.extractfile(member)  # Extract the image
+            assert image  # The image has to exist
+            pending.append((position, pool.submit(process_image, image.read())))
+        else:
+            pending.append((position, None))
+
+        if len(pending) >= max_pending:
+            yield pending.popleft()
+
+    while pending:
+        yield pending.popleft()
+
+
+def process_image(data: bytes) -> ProcessedImage | None:
+    """
+    Validate image meets requirements (640x640, etc.) and re-encode it to
+    `config.IMAGE_STORAGE_FORMAT`, opening it only once. Images that are
+    already in that format are kept byte for byte if `IMAGE_PASSTHROUGH`
+    is set. Returns `None` if the image is rejected. Runs inside an ingest
+    worker.
+    """
     try:
-        with PIL_Image.open(image_path) as img:
-            return bool(img.size == (640, 640))
+        with PIL_Image.open(BytesIO(data)) as img:
+            # Only the header has been read so far, so bad sizes are cheap
+            if img.size != (640, 640):
+                return None
+
+            width, height = img.size
+            if (
+                config.IMAGE_PASSTHROUGH
+                and img.format == config.IMAGE_STORAGE_FORMAT.upper()
+            ):
+                # Already in the right format, so check it is intact and keep it
+                img.verify()
+                stored = data
+            else:
+                output = BytesIO()
+                img.save(
+                    output,
+                    format=config.IMAGE_STORAGE_FORMAT,
+                    **config.IMAGE_ENCODER_OPTIONS.get(config.IMAGE_STORAGE_FORMAT, {}),
+                )
+                stored = output.getvalue()
     except Exception:
-        return False
+        return None
+
+    return {
+        "data": stored,
+        "width": width,
+        "height": height,
+        "file_size": len(stored),
+        "hash": hashlib.sha256(stored).hexdigest(),
+    }
 
 
 def validate_image_pre(image_member: tarfile.TarInfo) -> bool:
@@ -152,9 +309,16 @@ def estimate_upload_processing_time(session: Session, batch_id: UUID) -> float:
     if batch.status == UploadStatus.UPLOADING:
         return config.DEFAULT_PROCESSING_TIME
 
-    images_done = batch.images_valid + batch.images_rejected
+    images_done = batch.images_valid + batch.images_rejected + batch.images_deduplicated
+    if batch.images_total == 0 or images_done == 0:
+        # The total is only known once the archive has been read through
+        return config.DEFAULT_PROCESSING_TIME
+
     progress = images_done / batch.images_total
     assert batch.start_time
-    delta_time = (batch.start_time - datetime.now(timezone.utc)).total_seconds()
+    start_time = batch.start_time
+    if start_time.tzinfo is None:
+        start_time = start_time.replace(tzinfo=timezone.utc)  # Stored as UTC
+    delta_time = (datetime.now(timezone.utc) - start_time).total_seconds()
 
-    return float(delta_time / progress)
+    return float(delta_time / progress - delta_time)
@@ -1,4 +1,5 @@
 from collections.abc import Generator
+from datetime import datetime, timezone
 
 import pytest
 from fastapi.testclient import TestClient
@@ -6,8 +7,16 @@ from sqlmodel import Session, SQLModel, create_engine, select
 
 from app.core.config import DATABASE_URL
 from app.core.dependencies import get_password_hash
+from app.crud import label_category as label_category_crud
+from app.crud import upload_batch as upload_batch_crud
 from app.database import get_session
 from app.main import app
+from app.models.label_category import (
+    LabelCategory,
+    LabelCategoryCreate,
+    LabelSuperCategoryCreate,
+)
+from app.models.upload_batch import UploadBatch, UploadBatchCreate
 from app.models.user import User, UserCreate
 
 # Engine just for tests
@@ -76,3 +85,28 @@ def user(test_db: Session) -> Generator[User, None, None]:
 @pytest.fixture(scope="function")
 def api_key() -> Generator[str, None, None]:
     yield TEST_USER_API_KEY
+
+
+@pytest.fixture(scope="function")
+def category(test_db: Session) -> Generator[LabelCategory, None, None]:
+    """A new label category, in a new super category"""
+    super_category = label_category_crud.create_super(
+        test_db, LabelSuperCategoryCreate(name="test_super")
+    )
+    label_category = label_category_crud.create(
+        test_db,
+        LabelCategoryCreate(name="test", super_category_id=super_category.id),
+    )
+    assert isinstance(label_category, LabelCategory)
+    yield label_category
+
+
+@pytest.fixture(scope="function")
+def upload_batch(test_db: Session, user: User) -> Generator[UploadBatch, None, None]:
+    assert user.id is not None
+    yield upload_batch_crud.create(
+        test_db,
+        UploadBatchCreate(
+            capture_time=datetime.now(timezone.utc), file_size=0, user_id=user.id
+        ),
+    )
@@ -1,8 +1,15 @@
-from sqlmodel import Session
+from collections.abc import Generator
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
 
+import pytest
+from sqlmodel import Session, col, delete, select
+
+from app.core import config
 from app.crud import annotation as annotation_crud
 from app.crud import download_batch as download_batch_crud
 from app.crud import image as image_crud
+from app.crud import job as job_crud
 from app.crud import label_category as label_category_crud
 from app.crud import team as team_crud
 from app.crud import upload_batch as upload_batch_crud
@@ -13,6 +20,12 @@ from app.crud.base import (
     ModelType,
     UpdateSchemaType,
 )
+from app.models.annotation import Annotation, AnnotationCreate, ImageCategory
+from app.models.image import ImageCreate
+from app.models.job import Job, JobCreate, JobKind, JobStatus
+from app.models.label_category import LabelCategory, LabelCategoryCreate
+from app.models.upload_batch import UploadBatch
+from app.models.user import User
 
 
 def test_crud_layers_protocol() -> None:
@@ -20,6 +33,7 @@ def test_crud_layers_protocol() -> None:
         annotation_crud,
         download_batch_crud,
         image_crud,
+        job_crud,
         team_crud,
         label_category_crud,
         upload_batch_crud,
@@ -118,3 +132,161 @@ def generic_test_crud(
 #         UserCreate(username="testuser", password="testing", email="test@example.com"),
 #         UserUpdate(password="myNewPassword"),
 #     )
+
+
+@pytest.fixture(scope="function")
+def jobs(test_db: Session) -> Generator[list[Job], None, None]:
+    """Two queued jobs on an otherwise empty queue"""
+    test_db.exec(delete(Job))
+    test_db.commit()
+    yield [
+        job_crud.create(
+            test_db, JobCreate(kind=JobKind.CREATE_DOWNLOAD, target_id=uuid4())
+        )
+        for _ in range(2)
+    ]
+    test_db.exec(delete(Job))
+    test_db.commit()
+
+
+def test_job_lease_skips_locked(test_db: Session, jobs: list[Job]) -> None:
+    first, second = jobs
+    with Session(test_db.get_bind()) as other:
+        # Another worker is part way through claiming the first job
+        other.exec(select(Job).where(col(Job.id) == first.id).with_for_update()).one()
+
+        leased = job_crud.lease(test_db, "worker-a")
+        assert leased is not None
+        assert leased.id == second.id
+        assert leased.status == JobStatus.RUNNING
+        assert leased.leased_by == "worker-a"
+        assert leased.attempts == 1
+
+        assert job_crud.lease(test_db, "worker-a") is None
+
+    leased = job_crud.lease(test_db, "worker-b")
+    assert leased is not None
+    assert leased.id == first.id
+
+
+def test_job_lease_expired(test_db: Session, jobs: list[Job]) -> None:
+    for _ in jobs:
+        assert job_crud.lease(test_db, "worker-a") is not None
+    assert job_crud.lease(test_db, "worker-b") is None
+
+    # The first worker died without renewing
+    job_crud.update(
+        test_db,
+        jobs[0].id,  # type: ignore[arg-type]
+        {"leased_until": datetime.now(timezone.utc) - timedelta(seconds=1)},
+    )
+
+    leased = job_crud.lease(test_db, "worker-b")
+    assert leased is not None
+    assert leased.id == jobs[0].id
+    assert leased.leased_by == "worker-b"
+    assert leased.attempts == 2
+
+    # The first worker can no longer renew or finish it
+    job_id: int = leased.id  # type: ignore[assignment]
+    assert not job_crud.renew_lease(test_db, job_id, "worker-a")
+    assert job_crud.finish(test_db, job_id, "worker-a", "Too slow") is None
+    test_db.refresh(leased)
+    assert leased.status == JobStatus.RUNNING
+    assert leased.leased_by == "worker-b"
+    assert leased.leased_until is not None
+
+    finished = job_crud.finish(test_db, job_id, "worker-b")
+    assert finished is not None and finished.status == JobStatus.DONE
+
+
+def test_job_renew_lease(test_db: Session, jobs: list[Job]) -> None:
+    leased = job_crud.lease(test_db, "worker-a")
+    assert leased is not None and leased.leased_until is not None
+    job_id: int = leased.id  # type: ignore[assignment]
+    leased_until = leased.leased_until
+
+    assert not job_crud.renew_lease(test_db, job_id, "worker-b")
+    assert job_crud.renew_lease(test_db, job_id, "worker-a")
+    test_db.refresh(leased)
+    assert leased.leased_until is not None and leased.leased_until > leased_until
+
+    job_crud.finish(test_db, job_id, "worker-a")
+    assert not job_crud.renew_lease(test_db, job_id, "worker-a")
+
+
+def test_job_finish(test_db: Session, jobs: list[Job]) -> None:
+    job_id: int = jobs[0].id  # type: ignore[assignment]
+    job_crud.delete(test_db, jobs[1].id)  # type: ignore[arg-type]
+
+    for attempt in range(1, config.JOB_MAX_ATTEMPTS):
+        leased = job_crud.lease(test_db, "worker-a")
+        assert leased is not None and leased.attempts == attempt
+        finished = job_crud.finish(test_db, job_id, "worker-a", "Out of disk")
+        assert finished is not None
+        assert finished.status == JobStatus.QUEUED
+        assert finished.leased_by is None and finished.leased_until is None
+
+    assert job_crud.lease(test_db, "worker-a") is not None
+    finished = job_crud.finish(test_db, job_id, "worker-a", "Out of disk")
+    assert finished is not None
+    assert finished.status == JobStatus.FAILED
+    assert finished.error_message == "Out of disk"
+    assert job_crud.lease(test_db, "worker-a") is None
+
+    job_crud.update(test_db, job_id, {"status": JobStatus.QUEUED})
+    assert job_crud.lease(test_db, "worker-a") is not None
+    finished = job_crud.finish(test_db, job_id, "worker-a")
+    assert finished is not None
+    assert finished.status == JobStatus.DONE
+    assert finished.error_message is None
+
+
+def test_image_categories_follow_annotations(
+    test_db: Session, user: User, upload_batch: UploadBatch, category: LabelCategory
+) -> None:
+    assert upload_batch.id is not None and category.id is not None
+    other = label_category_crud.create(
+        test_db,
+        LabelCategoryCreate(name="other", super_category_id=category.super_category_id),
+    )
+    assert other.id is not None
+    image = image_crud.create(test_db, ImageCreate(batch=upload_batch.id), user)
+    assert image.id is not None
+
+    def memberships() -> set[int]:
+        return set(
+            test_db.exec(
+                select(ImageCategory.category_id).where(
+                    col(ImageCategory.image_id) == image.id
+                )
+            )
+        )
+
+    first = annotation_crud.create(
+        test_db, AnnotationCreate(image_id=image.id, category_id=category.id)
+    )
+    second = annotation_crud.create(
+        test_db, AnnotationCreate(image_id=image.id, category_id=category.id)
+    )
+    assert first.id is not None and second.id is not None
+    assert memberships() == {category.id}
+
+    annotation_crud.update(test_db, first.id, {"category_id": other.id})
+    assert memberships() == {category.id, other.id}
+
+    annotation_crud.update(test_db, second.id, {"category_id": other.id})
+    assert memberships() == {other.id}
+
+    annotation_crud.delete(test_db, first.id)
+    assert memberships() == {other.id}
+
+    annotation_crud.delete(test_db, second.id)
+    assert memberships() == set()
+
+    # Written before the table was kept in step
+    test_db.add(Annotation(image_id=image.id, category_id=category.id))
+    test_db.commit()
+    assert memberships() == set()
+    annotation_crud.backfill_image_categories(test_db)
+    assert memberships() == {category.id}
@@ -1,6 +1,13 @@
+import hashlib
+import tarfile
+from io import BytesIO
+
+import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
 from sqlmodel import Session
 
+from app.api.v1.upload import _verify_upload_archive
 from app.models.upload_batch import UploadBatchPublic
 from app.models.user import User
 
@@ -82,3 +89,50 @@ def test_upload(client: TestClient, test_db: Session, user: User, api_key: str)
     assert data
     assert data.error_message is None
     assert data.username == user.username
+
+
+def _tar_gz(files: dict[str, bytes]) -> bytes:
+    out = BytesIO()
+    with tarfile.open(fileobj=out, mode="w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, BytesIO(data))
+    return out.getvalue()
+
+
+def test_verify_upload_archive() -> None:
+    archive = _tar_gz({"a.png": b"first", "b.jpg": b"second"})
+    sink = BytesIO()
+
+    count = _verify_upload_archive(
+        BytesIO(archive), hashlib.sha256(archive).hexdigest(), sink
+    )
+    assert count == 2
+    assert sink.getvalue() == archive
+
+
+@pytest.mark.parametrize(
+    "archive, hash, status_code, detail",
+    [
+        (_tar_gz({"a.png": b"first"}), "0" * 64, 400, "hash mismatch"),
+        (b"not a tar.gz at all", None, 415, ".tar.gz"),
+        (
+            _tar_gz({"a.png": b"first", "notes.txt": b"second"}),
+            None,
+            400,
+            "not a supported file type",
+        ),
+        (_tar_gz({}), None, 400, "empty"),
+    ],
+    ids=["bad_hash", "not_gzip", "bad_extension", "empty"],
+)
+def test_verify_upload_archive_rejects(
+    archive: bytes, hash: str | None, status_code: int, detail: str
+) -> None:
+    with pytest.raises(HTTPException) as error:
+        _verify_upload_archive(
+            BytesIO(archive), hash or hashlib.sha256(archive).hexdigest()
+        )
+    assert error.value.status_code == status_code
+    assert detail in error.value.detail
@@ -0,0 +1,460 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import tarfile
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from typing import BinaryIO
+from uuid import UUID, uuid4
+
+import pytest
+from PIL import Image as PIL_Image
+from sqlalchemy import update as sql_update
+from sqlmodel import Session, col, select
+
+from app.core import config
+from app.core.compression import ParallelGzipWriter
+from app.crud import annotation as annotation_crud
+from app.crud import download_batch as download_batch_crud
+from app.crud import image as image_crud
+from app.crud import upload_batch as upload_batch_crud
+from app.database import init_db
+from app.models.annotation import Annotation
+from app.models.download_batch import (
+    AnnotationSelection,
+    ArchiveCompression,
+    DownloadBatch,
+    DownloadBatchCreate,
+    DownloadStatus,
+)
+from app.models.image import Image, ImageCreate
+from app.models.label_category import LabelCategory
+from app.models.upload_batch import UploadBatch, UploadStatus
+from app.models.user import User
+from app.services import buckets
+from app.tasks import image_processing
+from app.tasks.download_packaging import (
+    _get_random_images,
+    create_download_batch,
+    get_split,
+    release_download_batch,
+    sample_download_batch,
+    stream_download_batch,
+    use_cached_download_batch,
+)
+from app.tasks.image_processing import (
+    estimate_upload_processing_time,
+    process_batch_async,
+    process_image,
+)
+
+
+def test_process_image() -> None:
+    with open("app/tests/assets/test_img.png", "rb") as f:
+        data = f.read()
+    processed = process_image(data)
+
+    assert processed
+    assert processed["width"] == 640
+    assert processed["height"] == 640
+    assert processed["file_size"] == len(processed["data"])
+    assert processed["hash"] == hashlib.sha256(processed["data"]).hexdigest()
+
+    with PIL_Image.open(BytesIO(processed["data"])) as img:
+        assert img.format == config.IMAGE_STORAGE_FORMAT.upper()
+
+    if config.IMAGE_PASSTHROUGH and config.IMAGE_STORAGE_FORMAT == "png":
+        assert processed["data"] == data
+
+
+def test_process_image_reencodes() -> None:
+    jpeg = BytesIO()
+    PIL_Image.new("RGB", (640, 640)).save(jpeg, format="JPEG")
+    processed = process_image(jpeg.getvalue())
+
+    assert processed
+    with PIL_Image.open(BytesIO(processed["data"])) as img:
+        assert img.format == config.IMAGE_STORAGE_FORMAT.upper()
+
+
+def test_process_image_rejects() -> None:
+    assert process_image(b"not an image") is None
+
+    small = BytesIO()
+    PIL_Image.new("RGB", (320, 320)).save(small, format="JPEG")
+    assert process_image(small.getvalue()) is None
+
+
+def test_parallel_gzip_writer() -> None:
+    data = os.urandom(300_000) + b"barbell" * 50_000
+    out = BytesIO()
+    writer = ParallelGzipWriter(out, level=6, threads=4, block_size=64 * 1024)
+    for i in range(0, len(data), 10_000):
+        writer.write(data[i : i + 10_000])
+    writer.close()
+
+    assert gzip.decompress(out.getvalue()) == data
+
+
+def test_get_split() -> None:
+    splits = {"train": 0.8, "val": 0.1, "test": 0.1}
+    image_ids = [uuid4() for _ in range(1000)]
+
+    first = [get_split(i, splits, seed=7) for i in image_ids]
+    assert first == [get_split(i, splits, seed=7) for i in image_ids]
+    assert set(first) == set(splits)
+    assert 700 < first.count("train") < 900
+
+
+def _add_image(
+    session: Session, user: User, upload_batch: UploadBatch, category: LabelCategory
+) -> Image:
+    """An image with one annotation in `category`"""
+    assert upload_batch.id is not None and category.id is not None
+    image = image_crud.create(session, ImageCreate(batch=upload_batch.id), user)
+    assert image.id is not None
+    annotation = Annotation(image_id=image.id, category_id=category.id)
+    annotation.set_bbox((10, 20, 30, 40))
+    session.add(annotation)
+    session.commit()
+    return image
+
+
+def _request_download(
+    session: Session, user: User, category: LabelCategory
+) -> DownloadBatch:
+    assert category.id is not None
+    return download_batch_crud.create(
+        session,
+        DownloadBatchCreate(
+            annotations=[AnnotationSelection(id=category.id, super=False)],
+            count=10,
+            seed=42,
+        ),
+        user,
+    )
+
+
+def test_cached_download_batch(
+    test_db: Session, user: User, upload_batch: UploadBatch, category: LabelCategory
+) -> None:
+    image = _add_image(test_db, user, upload_batch, category)
+
+    first = _request_download(test_db, user, category)
+    assert not use_cached_download_batch(test_db, first)
+    assert first.fingerprint is not None
+    # Pretend the worker built it
+    first.archive_id = first.id
+    first.status = DownloadStatus.READY
+    test_db.add(first)
+    test_db.commit()
+
+    second = _request_download(test_db, user, category)
+    assert use_cached_download_batch(test_db, second)
+    assert second.fingerprint == first.fingerprint
+    assert second.archive_id == first.id
+    assert second.status == DownloadStatus.READY
+
+    annotation = image.annotations[0]
+    assert annotation.id is not None
+    annotation_crud.update(test_db, annotation.id, {"bbox_w": 50})
+    edited = _request_download(test_db, user, category)
+    assert not use_cached_download_batch(test_db, edited)
+    assert edited.fingerprint != first.fingerprint
+    assert edited.archive_id is None
+
+    assert image.id is not None
+    image_crud.delete(test_db, image.id)
+    deleted = _request_download(test_db, user, category)
+    assert not use_cached_download_batch(test_db, deleted)
+    assert deleted.fingerprint not in (first.fingerprint, edited.fingerprint)
+
+
+def test_release_download_batch(
+    test_db: Session, user: User, upload_batch: UploadBatch, category: LabelCategory
+) -> None:
+    _add_image(test_db, user, upload_batch, category)
+    buckets.init()
+
+    first = _request_download(test_db, user, category)
+    use_cached_download_batch(test_db, first)
+    assert first.id is not None
+    archive_id = first.id
+    with buckets.open_download_batch(archive_id, ".tar.gz") as f:
+        f.write(b"archive")
+    first.archive_id = archive_id
+    first.status = DownloadStatus.READY
+    test_db.add(first)
+    test_db.commit()
+
+    second = _request_download(test_db, user, category)
+    assert use_cached_download_batch(test_db, second)
+    path = buckets.get_download_batch_path(archive_id, ".tar.gz")
+
+    # The second batch still shares the archive
+    release_download_batch(test_db, first)
+    assert os.path.exists(path)
+
+    release_download_batch(test_db, second)
+    assert not os.path.exists(path)
+
+
+def test_delta_download_batches(
+    test_db: Session, user: User, upload_batch: UploadBatch, category: LabelCategory
+) -> None:
+    assert category.id is not None
+    selection = AnnotationSelection(id=category.id, super=False)
+    init_db()  # Like the worker, which builds the archives
+    buckets.init()
+    png = BytesIO()
+    PIL_Image.new("RGB", (640, 640)).save(png, format="PNG")
+
+    since = datetime.now(timezone.utc)
+    images = [_add_image(test_db, user, upload_batch, category) for _ in range(3)]
+    for image in images:
+        assert image.id is not None
+        buckets.create_image(png, image.id)
+    # Changed at the same moment, so only their ids tell them apart
+    test_db.execute(
+        sql_update(Image)
+        .where(col(Image.id).in_([image.id for image in images]))
+        .values(updated_at=datetime.now(timezone.utc))
+    )
+    test_db.commit()
+    images.sort(key=lambda image: image.id)  # type: ignore[arg-type, return-value]
+    deleted = _add_image(test_db, user, upload_batch, category)
+    assert deleted.id is not None
+    image_crud.delete(test_db, deleted.id)
+
+    def request(**kwargs: object) -> DownloadBatch:
+        return download_batch_crud.create(
+            test_db,
+            DownloadBatchCreate(
+                annotations=[selection],
+                count=2,
+                compression=ArchiveCompression.NONE,
+                seed=7,
+                **kwargs,
+            ),
+            user,
+        )
+
+    def download(**kwargs: object) -> tuple[DownloadBatch, set[str], list[str]]:
+        batch = request(**kwargs)
+        assert batch.id is not None
+        assert not use_cached_download_batch(test_db, batch)
+        create_download_batch(batch.id)
+        test_db.refresh(batch)
+        assert batch.status == DownloadStatus.READY
+
+        path = buckets.get_download_batch_path(batch.id, ".tar")
+        with tarfile.open(path) as archive:
+            names = set(archive.getnames())
+            deleted_file = archive.extractfile("deleted.json")
+            assert deleted_file is not None
+            return batch, names, json.load(deleted_file)
+
+    def file_names(*images: Image) -> set[str]:
+        return {f"{image.id}.{config.IMAGE_STORAGE_FORMAT}" for image in images}
+
+    first, names, deleted_ids = download(since=since)
+    assert file_names(*images[:2]) <= names
+    assert file_names(images[2]).isdisjoint(names)
+    assert deleted_ids == [deleted.id.hex]
+    # Full, so the next delta resumes after its last image
+    assert first.watermark_id == images[1].id
+
+    # The same request again shares the archive, and where it stopped
+    repeat = request(since=since)
+    assert use_cached_download_batch(test_db, repeat)
+    assert repeat.archive_id == first.id
+    assert repeat.watermark == first.watermark
+    assert repeat.watermark_id == first.watermark_id
+
+    second, names, deleted_ids = download(
+        since=repeat.watermark, since_id=repeat.watermark_id
+    )
+    assert file_names(images[2]) <= names
+    assert file_names(*images[:2]).isdisjoint(names)
+    # Deleted after the watermark, so it's listed again
+    assert deleted_ids == [deleted.id.hex]
+    # Caught up, so the next delta starts from when this one was requested
+    assert second.watermark == second.start_time
+    assert second.watermark_id is None
+
+
+def test_streamed_download_batch(
+    test_db: Session, user: User, upload_batch: UploadBatch, category: LabelCategory
+) -> None:
+    assert category.id is not None
+    buckets.init()
+    png = BytesIO(_png((0, 0, 0)))
+
+    def add_image() -> Image:
+        image = _add_image(test_db, user, upload_batch, category)
+        assert image.id is not None
+        buckets.create_image(png, image.id)
+        png.seek(0)
+        return image
+
+    kept, deleted = add_image(), add_image()
+    annotation_crud.backfill_image_categories(test_db)
+    batch = download_batch_crud.create(
+        test_db,
+        DownloadBatchCreate(
+            annotations=[AnnotationSelection(id=category.id, super=False)],
+            count=10,
+            non_match_images=False,
+            compression=ArchiveCompression.NONE,
+        ),
+        user,
+    )
+    assert batch.id is not None
+    sample_download_batch(test_db, batch)
+    assert batch.image_ids is not None
+    assert set(batch.image_ids) == {kept.id.hex, deleted.id.hex}  # type: ignore[union-attr]
+    assert batch.watermark == batch.start_time
+
+    # Added or deleted after the request, neither changes what is downloaded
+    add_image()
+    annotation_crud.backfill_image_categories(test_db)
+    assert deleted.id is not None
+    image_crud.delete(test_db, deleted.id)
+    for _ in range(2):
+        data = b"".join(stream_download_batch(batch.id))
+        with tarfile.open(fileobj=BytesIO(data)) as archive:
+            assert set(archive.getnames()) == {
+                f"{kept.id}.{config.IMAGE_STORAGE_FORMAT}",
+                "manifest.json",
+            }
+
+
+def test_get_random_images(
+    test_db: Session, user: User, upload_batch: UploadBatch, category: LabelCategory
+) -> None:
+    images = {_add_image(test_db, user, upload_batch, category).id for _ in range(50)}
+    query = select(Image).where(col(Image.batch) == upload_batch.id)
+
+    sample = [image.id for image in _get_random_images(test_db, query, 20, seed=3)]
+    assert len(set(sample)) == 20
+    assert set(sample) <= images
+    assert sample == [
+        image.id for image in _get_random_images(test_db, query, 20, seed=3)
+    ]
+
+    # A single run would be one unbroken stretch of the index, with one gap
+    keys = sorted(test_db.exec(query), key=lambda image: image.sample_key)
+    positions = [index for index, image in enumerate(keys) if image.id in sample]
+    gaps = [
+        (after - before) % len(keys)
+        for before, after in zip(positions, positions[1:] + positions[:1], strict=True)
+    ]
+    assert sum(gap > 1 for gap in gaps) > 1
+
+    everything = _get_random_images(test_db, query, 80, seed=3)
+    assert {image.id for image in everything} == images
+
+
+def test_estimate_upload_processing_time(
+    test_db: Session, upload_batch: UploadBatch
+) -> None:
+    assert upload_batch.id is not None
+    upload_batch_crud.update(
+        test_db,
+        upload_batch.id,
+        {
+            "status": UploadStatus.PROCESSING,
+            "start_time": datetime.now(timezone.utc) - timedelta(seconds=60),
+            "images_total": 4,
+            "images_valid": 1,
+            "images_deduplicated": 1,
+        },
+    )
+
+    # Half of the images are done, deduplicated ones included
+    left = estimate_upload_processing_time(test_db, upload_batch.id)
+    assert left == pytest.approx(60, abs=5)
+
+
+def _png(color: tuple[int, int, int], size: int = 640) -> bytes:
+    image = BytesIO()
+    PIL_Image.new("RGB", (size, size), color).save(image, format="PNG")
+    return image.getvalue()
+
+
+def test_process_batch_resumes(
+    test_db: Session,
+    upload_batch: UploadBatch,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    assert upload_batch.id is not None
+    batch_id = upload_batch.id
+    init_db()  # Like the worker, which processes uploads
+    buckets.init()
+    monkeypatch.setattr(config, "IMAGE_INSERT_CHUNK_SIZE", 2)
+
+    members = [
+        ("a.png", _png((1, 0, 0))),
+        ("b.png", _png((2, 0, 0))),
+        ("notes.txt", b"Not an image"),
+        ("c.png", _png((3, 0, 0))),
+        ("a_again.png", _png((1, 0, 0))),
+        ("d.png", _png((4, 0, 0))),
+        ("small.png", _png((5, 0, 0), size=320)),
+        ("e.png", _png((6, 0, 0))),
+    ]
+    with buckets.open_upload_batch(batch_id) as stored:
+        with tarfile.open(fileobj=stored, mode="w:gz") as tar:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, BytesIO(data))
+
+    images_path = os.path.join("data", config.IMAGES_BUCKET_NAME)
+    files_before = len(os.listdir(images_path))
+
+    def check(checkpoint: int, valid: int, rejected: int, deduplicated: int) -> None:
+        batch = upload_batch_crud.get(test_db, batch_id)
+        assert batch is not None
+        test_db.refresh(batch)
+        assert batch.checkpoint == checkpoint
+        assert batch.images_valid == valid
+        assert batch.images_rejected == rejected
+        assert batch.images_deduplicated == deduplicated
+
+        images = test_db.exec(select(Image).where(col(Image.batch) == batch_id)).all()
+        assert len(images) == valid
+        # Every stored file has its row, and every row its file
+        assert len(os.listdir(images_path)) == files_before + valid
+        for image in images:
+            assert os.path.exists(os.path.join(images_path, str(image.id)))
+
+    # Fail half way through storing the chunk of d and e
+    create_image = image_processing.create_image
+    calls = 0
+
+    def failing_create_image(image: BinaryIO, uuid: UUID) -> None:
+        nonlocal calls
+        calls += 1
+        if calls == 5:
+            raise OSError("Storage went away")
+        create_image(image, uuid)
+
+    monkeypatch.setattr(image_processing, "create_image", failing_create_image)
+    with pytest.raises(OSError):
+        asyncio.run(process_batch_async(batch_id))
+
+    # Kept up to the chunk of c and the copy of a, which was deduplicated
+    check(checkpoint=5, valid=3, rejected=1, deduplicated=1)
+    batch = upload_batch_crud.get(test_db, batch_id)
+    assert batch is not None and batch.status == UploadStatus.FAILED
+
+    monkeypatch.setattr(image_processing, "create_image", create_image)
+    asyncio.run(process_batch_async(batch_id))
+
+    check(checkpoint=8, valid=5, rejected=2, deduplicated=1)
+    test_db.refresh(batch)
+    assert batch.status == UploadStatus.COMPLETED
+    assert batch.images_total == 8
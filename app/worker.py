@@ -0,0 +1,122 @@
+"""
+Runs queued background jobs (upload processing and download packaging)
+outside of the API process. Start as many as you like, on as many
+machines as you like, with `python -m app.worker`. They share the queue
+through the database.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from types import FrameType
+
+from sqlmodel import Session
+
+from app.core import config
+from app.crud import job as job_crud
+from app.database import engine, init_db
+from app.models.job import Job, JobKind
+from app.services import buckets
+from app.tasks.download_packaging import create_download_batch
+from app.tasks.image_processing import process_batch_async
+
+logger = logging.getLogger("barbell.worker")
+
+_stop = threading.Event()
+
+
+def run_job(job: Job) -> None:
+    if job.kind == JobKind.PROCESS_UPLOAD:
+        asyncio.run(process_batch_async(job.target_id))
+    elif job.kind == JobKind.CREATE_DOWNLOAD:
+        create_download_batch(job.target_id)
+    else:
+        raise ValueError(f"Unknown job kind {job.kind}")
+
+
+@contextmanager
+def _keep_leased(job_id: int, worker: str) -> Iterator[None]:
+    """Renew the job's lease in the background while it runs"""
+    done = threading.Event()
+
+    def renew() -> None:
+        while not done.wait(config.JOB_LEASE_SECONDS / 3):
+            with Session(engine) as session:
+                if not job_crud.renew_lease(session, job_id, worker):
+                    # Another worker may be running it now. There's no safe
+                    # point to stop this run at, so it carries on, but it
+                    # won't be allowed to finish the job.
+                    logger.error("%s: lost the lease on job %s", worker, job_id)
+                    return
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
+
+
+def work(worker: str) -> None:
+    """Lease and run jobs until asked to stop"""
+    while not _stop.is_set():
+        with Session(engine) as session:
+            job = job_crud.lease(session, worker)
+
+        if job is None:
+            _stop.wait(config.WORKER_POLL_SECONDS)
+            continue
+
+        assert job.id
+        logger.info("%s: running %s job %s", worker, job.kind.value, job.id)
+        error = None
+        try:
+            with _keep_leased(job.id, worker):
+                run_job(job)
+        except Exception as e:
+            logger.exception("%s: job %s failed", worker, job.id)
+            error = str(e) or type(e).__name__
+
+        with Session(engine) as session:
+            if job_crud.finish(session, job.id, worker, error) is None:
+                logger.warning(
+                    "%s: job %s was taken over, not finishing it", worker, job.id
+                )
+
+
+def main() -> None:
+    logging.basicConfig(
+        level=logging.DEBUG if config.DEBUG else logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+
+    init_db()
+    buckets.init()
+
+    def stop(signum: int, frame: FrameType | None) -> None:
+        logger.info("Stopping once the current jobs are done")
+        _stop.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [
+        threading.Thread(target=work, args=(f"{name}:{i}",))
+        for i in range(config.WORKER_CONCURRENCY)
+    ]
+    logger.info("Starting %s worker threads as %s", len(threads), name)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()
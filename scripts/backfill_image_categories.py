@@ -0,0 +1,21 @@
+"""
+Fill `image_categories` from the annotations written before it was kept in
+step with them. Only needed once, on a database from before the table:
+
+    docker compose exec web uv run --no-sync python scripts/backfill_image_categories.py
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sqlmodel import Session  # noqa: E402
+
+from app.crud.annotation import backfill_image_categories  # noqa: E402
+from app.database import engine  # noqa: E402
+
+if __name__ == "__main__":
+    with Session(engine) as session:
+        backfill_image_categories(session)
+    print("✅ Backfilled image categories")